@@ -10,9 +10,13 @@
 import os
 import threading
 
+# ginga imports
+from ginga import AstroImage
+
 # local imports
 from util import fitsUtils
 from util import mosPlugin
+from util import solverUtils
 from util.mesAnalyze import MESAnalyze
 from util.mesInterface import MESInterface
 from util.mesLocate import MESLocate
@@ -74,13 +78,19 @@ class MESOffset(mosPlugin.MESPlugin):
          'label':"Image Directory", 'type':str, 'default':"$DATA/",
          'desc':"The directory in which the raw FITS images can be found"},
         
-        {'name':'recalc1',
-         'label':"Regenerate Star", 'type':bool,
-         'desc':"Do you want to generate new composite star images?"},
-        
         {'name':'interact1',
          'label':"Interact Star", 'type':bool,
-         'desc':"Do you want to interact with star position measurement?"}
+         'desc':"Do you want to interact with star position measurement?"},
+        
+        {'name':'rejection',
+         'label':"Outlier Rejection", 'type':int,
+         'options':["Worst First","Sigma Clip","RANSAC","Huber"],
+         'desc':"The way to find the objects that do not fit the others"},
+        
+        {'name':'max_residual',
+         'label':"Max Residual", 'type':float, 'default':1.0,
+         'format':"{} pix",
+         'desc':"The largest residual an object may have and still be used"}
     ]
     
     # mesoffset1.5 parameters
@@ -89,10 +99,6 @@ class MESOffset(mosPlugin.MESPlugin):
          'label':"Mask Frame", 'type':int, 'format':"MCSA{}.fits",
          'desc':"The frame number for the chip1 mask FITS image"},
         
-        {'name':'recalc2',
-         'label':"Regenerate", 'type':bool,
-         'desc':"Do you want to generate new composite mask images?"},
-        
         {'name':'interact2',
          'label':"Interact", 'type':bool,
          'desc':"Do you want to interact with hole position measurement?"}
@@ -120,13 +126,19 @@ class MESOffset(mosPlugin.MESPlugin):
          'label':"Image Directory", 'type':str, 'default':"$DATA/",
          'desc':"The directory in which the raw FITS images can be found"},
         
-        {'name':'recalc3',
-         'label':"Regenerate", 'type':bool,
-         'desc':"Do you want to generate new composite star-hole images?"},
-        
         {'name':'interact3',
          'label':"Interact", 'type':bool,
-         'desc':"Do you want to interact with star position measurement?"}
+         'desc':"Do you want to interact with star position measurement?"},
+        
+        {'name':'rejection',
+         'label':"Outlier Rejection", 'type':int,
+         'options':["Worst First","Sigma Clip","RANSAC","Huber"],
+         'desc':"The way to find the objects that do not fit the others"},
+        
+        {'name':'max_residual',
+         'label':"Max Residual", 'type':float, 'default':1.0,
+         'format':"{} pix",
+         'desc':"The largest residual an object may have and still be used"}
     ]
     
     # mesoffset3 parameters
@@ -151,13 +163,19 @@ class MESOffset(mosPlugin.MESPlugin):
          'label':"Image Directory", 'type':str, 'default':"$DATA/",
          'desc':"The directory in which the raw FITS images can be found"},
         
-        {'name':'recalc4',
-         'label':"Regenerate Mask", 'type':bool,
-         'desc':"Do you want to generate new composite mask images?"},
-        
         {'name':'interact4',
          'label':"Interact Mask", 'type':bool,
-         'desc':"Do you want to interact with hole position measurement?"}
+         'desc':"Do you want to interact with hole position measurement?"},
+        
+        {'name':'rejection',
+         'label':"Outlier Rejection", 'type':int,
+         'options':["Worst First","Sigma Clip","RANSAC","Huber"],
+         'desc':"The way to find the objects that do not fit the others"},
+        
+        {'name':'max_residual',
+         'label':"Max Residual", 'type':float, 'default':1.0,
+         'format':"{} pix",
+         'desc':"The largest residual an object may have and still be used"}
     ]
     
     # mesoffset3.5 parameters
@@ -166,10 +184,6 @@ class MESOffset(mosPlugin.MESPlugin):
          'label':"Star-Hole Frame", 'type':int, 'format':"MCSA{}.fits",
          'desc':"The frame number for the chip1 star-hole FITS image"},
         
-        {'name':'recalc5',
-         'label':"Regenerate", 'type':bool,
-         'desc':"Do you want to generate new composite star-hole images?"},
-        
         {'name':'interact5',
          'label':"Interact", 'type':bool,
          'desc':"Do you want to interact with star position measurement?"}
@@ -278,13 +292,13 @@ class MESOffset(mosPlugin.MESPlugin):
     
     def process_star_fits(self, *args):
         """ Use fitsUtils to combine raw data into a usable star mosaic """
-        self.process_fits('star', self.recalc1,
-                          next_step=self.load_processed_star)
+        self.process_fits('star', next_step=self.load_processed_star)
     
-    def load_processed_star(self, *args):
+    def load_processed_star(self, data=None, header=None):
         """ Load the star frame FITS image that was processed by fitsUtils """
         self.open_fits(filename=self.rootname+"_star.fits",
-                       next_step=self.mes_star)
+                       next_step=self.mes_star,
+                       data=data, header=header)
     
     def mes_star(self, *args):
         """ Call MESLocate in star mode on the current image """
@@ -307,13 +321,13 @@ class MESOffset(mosPlugin.MESPlugin):
     def process_mask_fits(self, *args):
         """ Use fitsUtils to comine raw data into a usable mask mosaic """
         self.__dict__.update(self.database)
-        self.process_fits('mask', self.recalc2,
-                          next_step=self.load_processed_mask)
+        self.process_fits('mask', next_step=self.load_processed_mask)
     
-    def load_processed_mask(self, *args):
+    def load_processed_mask(self, data=None, header=None):
         """ Load the mask frame FITS image that was processed by fitsUtils """
         self.open_fits(filename=self.rootname+"_mask.fits",
-                       next_step=self.mes_hole)
+                       next_step=self.mes_hole,
+                       data=data, header=header)
     
     def mes_hole(self, *args):
         """ Call MESLocate in mask mode on the current image """
@@ -330,7 +344,9 @@ class MESOffset(mosPlugin.MESPlugin):
     def res_viewer_1(self, *args):
         """ Call MESAnalyze on the data from mes_star and mes_hole """
         self.mes_analyze.start(self.star_locations, self.hole_locations,
-                               next_step=self.end_mesoffset1)
+                               next_step=self.end_mesoffset1,
+                               rejection=solverUtils.REJECTIONS[self.rejection],
+                               max_residual=self.max_residual)
     
     def end_mesoffset1(self, *args):
         """ Finish off the first, rough, star/hole location """
@@ -363,13 +379,13 @@ class MESOffset(mosPlugin.MESPlugin):
     
     def process_starhole_fits(self, *args):
         """ Use fitsUtils to combine raw data into a compound starhole image """
-        self.process_fits('starhole', self.recalc3,
-                          next_step=self.load_processed_starhole)
+        self.process_fits('starhole', next_step=self.load_processed_starhole)
     
-    def load_processed_starhole(self, *args):
+    def load_processed_starhole(self, data=None, header=None):
         """ Load the finished starhole image into ginga """
         self.open_fits(filename=self.rootname+"_starhole.fits",
-                       next_step=self.mes_starhole)
+                       next_step=self.mes_starhole,
+                       data=data, header=header)
     
     def mes_starhole(self, *args):
         """ Call MESLocate in starhole mode on the current image """
@@ -386,7 +402,9 @@ class MESOffset(mosPlugin.MESPlugin):
     def res_viewer_2(self, *args):
         """ Call MESAnalyze on the data from mes_star and mes_starhole """
         self.mes_analyze.start(self.star_locations, self.hole_locations,
-                               next_step=self.end_mesoffset2)
+                               next_step=self.end_mesoffset2,
+                               rejection=solverUtils.REJECTIONS[self.rejection],
+                               max_residual=self.max_residual)
     
     def end_mesoffset2(self, *args):
         """ Finish off the second star-hole location """
@@ -413,13 +431,13 @@ class MESOffset(mosPlugin.MESPlugin):
     
     def process_new_mask_fits(self, *args):
         """ Process the new, updated mask frames """
-        self.process_fits('mask', self.recalc4,
-                          next_step=self.load_new_mask)
+        self.process_fits('mask', next_step=self.load_new_mask)
     
-    def load_new_mask(self, *args):
+    def load_new_mask(self, data=None, header=None):
         """ Load the updated mask FITS image """
         self.open_fits(filename=self.rootname+"_mask.fits",
-                       next_step=self.mes_hole_again)
+                       next_step=self.mes_hole_again,
+                       data=data, header=header)
     
     def mes_hole_again(self, *args):
         """ Get hole positions on the new mask frame """
@@ -445,13 +463,13 @@ class MESOffset(mosPlugin.MESPlugin):
     def process_new_starhole_fits(self, *args):
         """ Process the new starhole FITS images """
         self.__dict__.update(self.database)
-        self.process_fits('starhole', self.recalc5,
-                          next_step=self.load_new_starhole)
+        self.process_fits('starhole', next_step=self.load_new_starhole)
     
-    def load_new_starhole(self, *args):
+    def load_new_starhole(self, data=None, header=None):
         """ Load the updated starhole FITS image """
         self.open_fits(filename=self.rootname+"_starhole.fits",
-                       next_step=self.mes_starhole_again)
+                       next_step=self.mes_starhole_again,
+                       data=data, header=header)
     
     def mes_starhole_again(self, *args):
         """ Get star-hole positions on the new star-hole frame """
@@ -468,7 +486,9 @@ class MESOffset(mosPlugin.MESPlugin):
     def res_viewer_3(self, *args):
         """ Call MESAnalyze on the data from mes_star and mes_hole """
         self.mes_analyze.start(self.star_locations, self.hole_locations,
-                               next_step=self.end_mesoffset3)
+                               next_step=self.end_mesoffset3,
+                               rejection=solverUtils.REJECTIONS[self.rejection],
+                               max_residual=self.max_residual)
     
     def end_mesoffset3(self, *args):
         """ Finish off the third, fine star-hole location with updated masks """
@@ -486,67 +506,60 @@ class MESOffset(mosPlugin.MESPlugin):
         return self.mes_analyze.offset
     
     
-    def process_fits(self, mode, recalc=True, next_step=None):
+    def process_fits(self, mode, next_step=None):
         """
         Plug some values into fitsUtils and start a new thread to create a
-        processed FITS image to be loaded and used
+        processed FITS image to be loaded and used. fitsUtils will reuse a
+        cached mosaic if none of the inputs have changed since it was made
         @param mode:
             A string - either 'star', 'mask', or 'starhole'
-        @param framenum:
-            The chip1 frame number for the first set of input images
-        @param recalc:
-            Whether new images should even be processed
         @param next_step:
             The function to be called when this is done
-        @returns:
-            A threading.Event object to be used if the user ever decides to
-            terminate the task
-        @raises IOError:
-            If the specified images cannot be found
         """
-        out_filename = self.rootname+"_"+mode+".fits"
-        
-        # if regenerate is off, don't bother with any of this
-        if not recalc:
-            if os.path.isfile(out_filename):
-                if next_step != None:
-                    next_step()
-            else:
-                self.mes_interface.log("No previous image found at "+
-                                       out_filename+". Please change your "+
-                                       "working directory or rootname, or "+
-                                       "enable the 'Regenerate' option",
-                                       level='error')
-        
-        # otherwise, start the appropriate process in a new thread
-        else:
-            self.go_to_gui('log')
-            c, i = self.c_file, self.img_dir
-            f = out_filename
-            e = threading.Event()
-            l = self.mes_interface.log
-            if mode == 'star':
-                n1, n2 = int(self.star_chip1), int(self.sky_chip1)
-            elif mode == 'starhole':
-                n1, n2 = int(self.starhole_chip1), int(self.mask_chip1)
-            elif mode == 'mask':
-                n1, n2 = int(self.mask_chip1), None
-            task = lambda: fitsUtils.auto_process_fits(mode,n1,n2,c,i,f,e,l,
-                                                       next_step=next_step)
-            self.fv.nongui_do(task)
-            self.terminate = e
-    
-    
-    def open_fits(self, filename, next_step=None):
+        self.go_to_gui('log')
+        c, i = self.c_file, self.img_dir
+        f = self.rootname+"_"+mode+".fits"
+        e = threading.Event()
+        l = self.mes_interface.log
+        if mode == 'star':
+            n1, n2 = int(self.star_chip1), int(self.sky_chip1)
+        elif mode == 'starhole':
+            n1, n2 = int(self.starhole_chip1), int(self.mask_chip1)
+        elif mode == 'mask':
+            n1, n2 = int(self.mask_chip1), None
+        task = lambda: fitsUtils.auto_process_fits(mode,n1,n2,c,i,f,e,l,
+                                                   next_step=next_step)
+        self.fv.nongui_do(task)
+        self.terminate = e
+    
+    
+    def open_fits(self, filename, next_step=None, data=None, header=None):
         """
         Open a FITS image and display it in ginga, then call a function
         @param filename:
             The name of the fits file
         @param next_step:
             The function to call once the image has been loaded
+        @param data:
+            The image as a numpy array, if it is already in memory; if this is
+            None, the image will be read from filename instead
+        @param header:
+            The astropy.io.fits.Header that goes with data
         """
         self.image_set_next_step = next_step
-        self.fitsimage.make_callback('drag-drop', [filename])
+        if data is None:
+            self.fitsimage.make_callback('drag-drop', [filename])
+            return
+        
+        image = AstroImage.AstroImage(logger=self.logger)
+        image.load_data(data)
+        if header != None:
+            image.update_keywords(header)
+        image.set(name=os.path.splitext(os.path.basename(filename))[0],
+                  path=os.path.abspath(filename))
+        chname = self.fv.get_channel_name(self.fitsimage)
+        self.fv.gui_do(self.fv.add_image, image.get('name'), image,
+                       chname=chname)
     
     
     def image_set_cb(self, *args):
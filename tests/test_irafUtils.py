@@ -0,0 +1,124 @@
+#
+# test_irafUtils.py -- Tests for the native IRAF file readers
+# Works in conjunction with MESOffset ginga plugin for MOS Acquisition
+#
+# Justin Kunimune
+#
+
+
+
+# standard imports
+import os
+import shutil
+import tempfile
+import unittest
+
+# third-party imports
+import numpy as np
+
+# local imports
+from util import irafUtils
+
+
+
+def op(opcode, data=0):
+    """ Encode one line list instruction """
+    return [(opcode << 12) + data]
+
+
+def set_high(value):
+    """ Encode an SH instruction, which sets the high value """
+    return op(1, value & 4095) + [value >> 12]
+
+
+def new_line_list(instructions):
+    """ Wrap some instructions in the current seven-word header """
+    length = 7 + len(instructions)
+    return [0, 7, -100, length & 32767, length >> 15, 0, 0] + instructions
+
+
+def old_line_list(instructions):
+    """ Wrap some instructions in the old three-word header """
+    return [1, 3, 3 + len(instructions)] + instructions
+
+
+def values(*vals):
+    """ Encode a line list that decodes to exactly these values """
+    instructions = []
+    for v in vals:
+        if v == 0:
+            instructions += op(0, 1)
+        else:
+            instructions += set_high(v) + op(4, 1)
+    return new_line_list(instructions)
+
+
+
+class ReadPixelListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+    def write_pl(self, words):
+        """ Save a pixel list with a dummy header in front of the line lists """
+        filename = os.path.join(self.tmp, 'mask.pl')
+        f = open(filename, 'wb')
+        f.write('\x01\x02' * 20)
+        f.write(np.array(words, dtype='>i2').tostring())
+        f.close()
+        return filename
+
+
+    def test_empty_trailing_lines(self):
+        # a 6x5 mask; lines 0 and 2 share a line list, and the index stops
+        # after line 2, so lines 3 and 4 must be zero-filled to the empty line
+        descriptor = values(0, 2, 6, 5)
+        index = values(7, 0, 7)
+        empty = new_line_list([])
+        line = old_line_list(op(0, 1) + op(4, 2) + op(5, 2))
+        filename = self.write_pl(descriptor + index + empty + line)
+
+        expected = np.zeros((5, 6), dtype=bool)
+        expected[[0,2], 1:3] = True
+        expected[[0,2], 4] = True
+        np.testing.assert_array_equal(irafUtils.read_pixel_list(filename),
+                                      expected)
+
+
+    def test_not_a_pixel_list(self):
+        filename = self.write_pl([1, 2, 3, 4])
+        self.assertRaises(ValueError, irafUtils.read_pixel_list, filename)
+
+
+
+class DecodeLineListTest(unittest.TestCase):
+
+    def test_old_format(self):
+        ll = np.array(old_line_list(op(0, 2) + set_high(5) + op(4, 3)) +
+                      [999, 999])
+        self.assertEqual(irafUtils.line_list_length(ll), 7)
+        np.testing.assert_array_equal(irafUtils.decode_line_list(ll),
+                                      [0, 0, 5, 5, 5])
+
+
+    def test_new_format(self):
+        ll = np.array(new_line_list(op(5, 3) + op(6, 2) + op(7, 1)))
+        self.assertEqual(irafUtils.line_list_length(ll), 10)
+        np.testing.assert_array_equal(irafUtils.decode_line_list(ll),
+                                      [0, 0, 1, 3, 2])
+
+
+    def test_npix(self):
+        ll = np.array(new_line_list(op(4, 2)))
+        np.testing.assert_array_equal(irafUtils.decode_line_list(ll, 4),
+                                      [1, 1, 0, 0])
+        np.testing.assert_array_equal(irafUtils.decode_line_list(ll, 1),
+                                      [1])
+
+#END
+
@@ -0,0 +1,173 @@
+#
+# cacheUtils.py -- A utility file for keeping expensive arrays on disk
+# Works in conjunction with MESOffset ginga plugin for MOS Acquisition
+#
+# Justin Kunimune
+#
+
+
+
+# standard imports
+import hashlib
+import os
+import tempfile
+
+# third-party imports
+import numpy as np
+
+
+
+# constants
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ginga', 'mos_cache')
+CACHE_VERSION = 1   # increment whenever the format of a cached array changes
+
+
+
+def hash_key(*args, **kwargs):
+    """
+    Build a cache key out of some values and the contents of some files
+    @param args:
+        Any values with stable string representations (strings, numbers,
+        tuples, etc.) that the cached result depends on
+    @param files:
+        A sequence of filenames whose contents the cached result depends on
+    @returns:
+        A hexadecimal string that changes whenever any of the inputs does
+    @raises IOError:
+        If one of the files cannot be read
+    """
+    sha = hashlib.sha1(repr((CACHE_VERSION,) + args))
+    for filename in kwargs.get('files', ()):
+        f = open(filename, 'rb')
+        sha.update(f.read())
+        f.close()
+    return sha.hexdigest()
+
+
+def cache_path(key, ext='.npy'):
+    """
+    Get the location of the cache file with the given key
+    @param key:
+        A string, as returned by hash_key
+    @param ext:
+        The file extension of the cached file
+    @returns:
+        The absolute filename of the cached file, whether it exists or not
+    """
+    return os.path.join(CACHE_DIR, key+ext)
+
+
+def cached_array(key, compute):
+    """
+    Load the array with this key from the cache as a read-only memory map,
+    or compute it and save it there if it is not cached yet
+    @param key:
+        A string, as returned by hash_key
+    @param compute:
+        A function that takes no arguments and returns the numpy array to
+        cache
+    @returns:
+        The cached numpy array, or the freshly computed one if it could not be
+        saved
+    """
+    filename = cache_path(key)
+    try:
+        return np.load(filename, mmap_mode='r')
+    except (IOError, ValueError):
+        pass
+    
+    array = compute()
+    try:
+        save_array(filename, array)
+    except (IOError, OSError):
+        return array
+    return np.load(filename, mmap_mode='r')
+
+
+def save_array(filename, array):
+    """
+    Write an array to the cache, so that other threads or processes never see
+    a partially written file
+    @param filename:
+        The final location of the .npy file
+    @param array:
+        The numpy array to save
+    @raises IOError, OSError:
+        If the cache directory is not writable
+    """
+    save_file(filename, lambda f: np.save(f, array))
+
+
+def save_file(filename, write):
+    """
+    Write a file to the cache under a temporary name, and then move it into
+    place, so that other threads or processes never see it partially written
+    @param filename:
+        The final location of the file
+    @param write:
+        A function that takes an open binary file object and writes the
+        contents to it
+    @raises IOError, OSError:
+        If the cache directory is not writable
+    """
+    if not os.path.isdir(CACHE_DIR):
+        try:
+            os.makedirs(CACHE_DIR)
+        except OSError:
+            if not os.path.isdir(CACHE_DIR):   # another thread may have won
+                raise
+    
+    ext = os.path.splitext(filename)[1]
+    fd, temp_filename = tempfile.mkstemp(suffix=ext, dir=CACHE_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(temp_filename, filename)
+    except:
+        os.remove(temp_filename)
+        raise
+
+
+def touch(filename):
+    """
+    Mark a cache file as recently used, so that evict keeps it the longest
+    @param filename:
+        The location of the cached file
+    """
+    try:
+        os.utime(filename, None)
+    except OSError:
+        pass
+
+
+def evict(ext, keep):
+    """
+    Delete the least recently used cache files of one type, so that only a
+    certain number of them remain
+    @param ext:
+        The file extension of the files to consider
+    @param keep:
+        The number of most recently used files to leave alone
+    """
+    try:
+        filenames = [os.path.join(CACHE_DIR, f) for f in os.listdir(CACHE_DIR)
+                     if f.endswith(ext)]
+    except OSError:
+        return
+    
+    ages = []
+    for filename in filenames:
+        try:
+            ages.append((os.path.getmtime(filename), filename))
+        except OSError:     # another thread may have deleted it already
+            pass
+    ages.sort(reverse=True)
+    
+    for mtime, filename in ages[keep:]:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+#END
+
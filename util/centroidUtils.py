@@ -0,0 +1,1140 @@
+#
+# centroidUtils.py -- A utility file with methods to find the centers of objects
+# Works in conjunction with MESOffset ginga plugin for MOS Acquisition
+#
+# Justin Kunimune
+#
+
+
+
+# standard imports
+import time
+
+# third-party imports
+import numpy as np
+from numpy import ma
+from scipy import ndimage
+from scipy import optimize
+
+
+
+# constants
+GRID_CACHE = {}     # the index grids for each cutout shape, from index_grids
+KERNELS = ('masked', 'weights')     # the ways to compute the centers of mass
+ALGORITHMS = ('com', 'window', 'gaussian', 'moffat', 'hole')   # get_algorithm
+MODE_ALGORITHMS = {'star':'com', 'mask':'com', 'starhole':'window'} # benchmark
+MAX_WINDOW_ITER = 20    # the most times windowed_centroids will recenter
+WINDOW_TOL = 1e-4       # the shift in pixels at which a windowed centroid stops
+FIT_WINDOW = 3.0        # the radius of a profile fit, in expected object radii
+MOFFAT_BETA = 2.5       # the initial guess for the moffat power index
+MAX_FIT_CALLS = 100     # the most times a profile fit may evaluate its model
+NUM_RAYS = 64           # the number of rays along which to look for hole edges
+EDGE_ITER = 3           # the number of times hole_edge_centroids will refit
+
+
+
+def locate_obj(bounds, masks, image, viewer=None, min_search_radius=None,
+               thresh=3, kernel='masked', mode='star', algorithm=None):
+    """
+    Finds the center of an object using center of mass calculation, or any of
+    the other ALGORITHMS
+    @param bounds:
+        A tuple of floats x1, y1, x2, y2, r. The object should be within
+        this box
+    @param masks:
+        A list of tuples of the form (x1, y1, x2, y2, kind) where kind is either
+        'mask' or 'crop' and everything else is floats. Each tuple in masks
+        is one drag of the mouse that ommitted either its interior or its
+        exterior. This may also be a boolean numpy array the shape of the
+        cutout that has all of the drags combined already, as returned by
+        add_drag
+    @param image:
+        The AstroImage containing the data necessary for this calculation
+    @param viewer:
+        The viewer object that will display the new data, if desired
+    @param min_search_radius:
+        The smallest radius that this will search; the other algorithms also
+        take this to be the expected radius of the object
+    @param thresh:
+        The number of standard deviations above the mean a data point must
+        be to be considered valid
+    @param kernel:
+        One of KERNELS - 'masked' to reproduce the original numpy.ma
+        calculation exactly, or 'weights' for plain arrays, which is faster
+        and agrees to within rounding error
+    @param mode:
+        Either 'star' or 'mask' or 'starhole'; picks the algorithm from
+        MODE_ALGORITHMS if no algorithm is given
+    @param algorithm:
+        One of ALGORITHMS, or None to use the one for this mode
+    @returns:
+        A tuple of two floats representing the actual location of the object
+        or a tuple of NaNs if no star could be found
+    """
+    find_centers = get_algorithm(mode, algorithm)
+    stamp = cut_stamp(bounds, masks, image)
+    
+    # display the new data on the viewer, if necessary
+    if viewer != None:
+        viewer.get_settings().set(autocut_method='minmax')
+        viewer.set_data(threshold_stamp(stamp, thresh=thresh, kernel=kernel)[0])
+    
+    return tuple(find_centers([stamp], min_search_radius, thresh=thresh,
+                              kernel=kernel)[0])
+
+
+def locate_objs(bounds_list, masks_list, image, min_search_radius=None,
+                thresh=3, kernel='masked', mode='star', algorithm=None):
+    """
+    Finds the centers of a whole set of objects at once, giving the same
+    results as calling locate_obj on each of them
+    @param bounds_list:
+        A sequence of bounds tuples, as taken by locate_obj, one for each object
+    @param masks_list:
+        A sequence of lists of drags or drag bitmaps, as taken by locate_obj,
+        one for each object
+    @param image:
+        The AstroImage containing the data necessary for this calculation
+    @param min_search_radius:
+        The smallest radius that this will search
+    @param thresh:
+        The number of standard deviations above the mean a data point must
+        be to be considered valid
+    @param kernel:
+        One of KERNELS; see locate_obj
+    @param mode:
+        Either 'star' or 'mask' or 'starhole'; see locate_obj
+    @param algorithm:
+        One of ALGORITHMS, or None to use the one for this mode
+    @returns:
+        A numpy array of three columns: the x, y, and radius of each object,
+        with NaNs in every row where no object could be found
+    """
+    find_centers = get_algorithm(mode, algorithm)
+    stamps = [cut_stamp(bounds, masks, image)
+              for bounds, masks in zip(bounds_list, masks_list)]
+    return find_centers(stamps, min_search_radius, thresh=thresh, kernel=kernel)
+
+
+def get_algorithm(mode, algorithm=None):
+    """
+    Look up the function that implements a centroid algorithm. Every one of
+    these functions takes a list of stamps from cut_stamp, the minimum search
+    radius, and the thresh and kernel keywords, and returns a numpy array of
+    the x, y, and radius of each object
+    @param mode:
+        Either 'star' or 'mask' or 'starhole'
+    @param algorithm:
+        One of ALGORITHMS, or None to use MODE_ALGORITHMS[mode]
+    @returns:
+        The function for that algorithm
+    @raises ValueError:
+        If the algorithm or mode is not recognized
+    """
+    if algorithm == None:
+        try:
+            algorithm = MODE_ALGORITHMS[mode]
+        except KeyError:
+            raise ValueError("Unknown mode: {}".format(mode))
+    if algorithm == 'com':
+        return com_centroids
+    elif algorithm == 'window':
+        return windowed_centroids
+    elif algorithm == 'gaussian':
+        return gaussian_fit_centroids
+    elif algorithm == 'moffat':
+        return moffat_fit_centroids
+    elif algorithm == 'hole':
+        return hole_edge_centroids
+    else:
+        raise ValueError("Unknown centroid algorithm: {}".format(algorithm))
+
+
+def cut_stamp(bounds, masks, image):
+    """
+    Cut out the data around one object and work out which pixels are masked
+    @param bounds:
+        A tuple of floats x1, y1, x2, y2, r, as taken by locate_obj
+    @param masks:
+        A list of drags or a drag bitmap, as taken by locate_obj
+    @param image:
+        The AstroImage containing the data
+    @returns:
+        A tuple of the raw numpy array, the boolean mask, the float x and y of
+        the corner of the cutout, and the initial search radius
+    """
+    # start by getting the raw data from the image matrix
+    raw, x0,y0,x1,y1 = image.cutout_adjust(*bounds[:4])
+    search_radius = bounds[4]
+    x_arr, y_arr, r_arr = index_grids(raw.shape)
+    
+    # crop data to circle
+    mask_tot = r_arr > search_radius
+    
+    # mask data based on masks
+    if isinstance(masks, np.ndarray):
+        mask_tot = np.logical_or(mask_tot, masks)
+    else:
+        for drag in masks:
+            mask = rasterize_drag(drag, raw.shape, x0, y0)
+            mask_tot = np.logical_or(mask_tot, mask)
+    
+    return raw, mask_tot, x0, y0, search_radius
+
+
+def rasterize_drag(drag, shape, x0, y0):
+    """
+    Work out which pixels of a cutout one drag omits
+    @param drag:
+        A tuple of the form (x1, y1, x2, y2, kind), as in locate_obj
+    @param shape:
+        The shape of the cutout
+    @param x0:
+        The x coordinate of the corner of the cutout, from cutout_adjust
+    @param y0:
+        The y coordinate of the corner of the cutout, from cutout_adjust
+    @returns:
+        A boolean numpy array of the given shape that is True wherever the
+        drag masks the data
+    """
+    x1, y1, x2, y2, kind = (int(drag[0])-int(x0)+1, int(drag[1])-int(y0)+1,
+                            int(drag[2])-int(x0)+1, int(drag[3])-int(y0)+1,
+                            drag[4])
+    mask = np.zeros(shape, dtype=bool)
+    mask[y1:y2, x1:x2] = True
+    if kind == 'crop':
+        mask = np.logical_not(mask)
+    return mask
+
+
+def add_drag(drag_mask, drag, bounds, image):
+    """
+    Combine the bitmap of some drags with one more drag, so that the drags on
+    an object never need to be rasterized more than once each
+    @param drag_mask:
+        The boolean numpy array of the drags so far, as returned by this
+        function, or None if there are none
+    @param drag:
+        The new drag, as a tuple of the form (x1, y1, x2, y2, kind)
+    @param bounds:
+        The bounds of the object, as taken by locate_obj
+    @param image:
+        The AstroImage that the object is in
+    @returns:
+        A new boolean numpy array of the combined drags, in the coordinates of
+        the object's cutout; drag_mask is left as it was
+    """
+    raw, x0,y0,x1,y1 = image.cutout_adjust(*bounds[:4])
+    mask = rasterize_drag(drag, raw.shape, x0, y0)
+    if drag_mask is not None:
+        np.logical_or(mask, drag_mask, out=mask)
+    return mask
+
+
+def threshold_stamp(stamp, thresh=3, kernel='masked'):
+    """
+    Subtract the threshold from a stamp and zero everything below it, for the
+    center of mass calculation
+    @param stamp:
+        A tuple, as returned by cut_stamp
+    @param thresh:
+        The number of standard deviations above the mean a data point must
+        be to be considered valid
+    @param kernel:
+        One of KERNELS; see locate_obj
+    @returns:
+        A tuple like the stamp, but with the thresholded numpy array (which is
+        zero wherever it is masked) in place of the raw one
+    """
+    raw, mask_tot = stamp[:2]
+    
+    # apply mask, calculate threshold, normalize, and coerce data positive
+    if kernel == 'masked':
+        data = ma.masked_array(raw, mask=mask_tot)
+        threshold = thresh*ma.std(data) + ma.mean(data)
+        data = data - threshold
+        data = ma.clip(data, 0, float('inf')).filled(0)
+    elif kernel == 'weights':
+        valid = raw[~mask_tot]
+        if valid.size > 0:
+            threshold = (thresh*valid.std(dtype=np.float64) +
+                         valid.mean(dtype=np.float64))
+        else:
+            threshold = 0
+        data = np.subtract(raw, threshold, dtype=np.float32)
+        np.maximum(data, 0, out=data)
+        data[mask_tot] = 0
+    else:
+        raise ValueError("Unknown centroid kernel: {}".format(kernel))
+    return (data,) + tuple(stamp[1:])
+
+
+def com_centroids(stamps, min_search_radius=None, thresh=3, kernel='masked'):
+    """
+    The 'com' algorithm: the iterative, shrinking-aperture center of mass of
+    the thresholded data
+    @param stamps:
+        A list of tuples, as returned by cut_stamp
+    @param min_search_radius:
+        The smallest radius that this will search, or None to use half of each
+        stamp's initial search radius
+    @param thresh:
+        The number of standard deviations above the mean a data point must
+        be to be considered valid
+    @param kernel:
+        One of KERNELS; see locate_obj
+    @returns:
+        A numpy array of three columns: the x, y, and radius of each object
+    """
+    stamps = [threshold_stamp(stamp, thresh=thresh, kernel=kernel)
+              for stamp in stamps]
+    return locate_stamps(stamps, min_search_radius, kernel=kernel)
+
+
+def locate_stamps(stamps, min_search_radius=None, kernel='masked'):
+    """
+    Find the centers of mass of a list of thresholded stamps, batching together
+    all of the stamps that have the same shape
+    @param stamps:
+        A list of tuples, as returned by threshold_stamp
+    @param min_search_radius:
+        The smallest radius that this will search, or None to use half of each
+        stamp's initial search radius
+    @param kernel:
+        One of KERNELS; see locate_obj
+    @returns:
+        A numpy array of three columns: the x, y, and radius of each object
+    """
+    output = np.empty((len(stamps), 3))
+    for shape, idx in group_by_shape(stamps).items():
+        data = np.array([stamps[i][0] for i in idx])
+        mask = np.array([stamps[i][1] for i in idx])
+        search_radius = np.array([stamps[i][4] for i in idx], dtype=float)
+        if min_search_radius == None:
+            min_sr = search_radius/2
+        else:
+            min_sr = np.full(len(idx), min_search_radius, dtype=float)
+        x_cen, y_cen, radius = centroid_stack(data, mask, search_radius, min_sr,
+                                              kernel=kernel)
+        
+        for j, i in enumerate(idx):
+            x0, y0 = stamps[i][2:4]
+            output[i] = (x0 + x_cen[j] - 0.5, y0 + y_cen[j] - 0.5, radius[j])
+    return output
+
+
+def centroid_stack(data, mask, search_radius, min_search_radius,
+                   kernel='masked'):
+    """
+    Run the iterative, shrinking-aperture center of mass calculation on a stack
+    of equally sized stamps all at once. Each stamp starts at the center of its
+    cutout, and is recentered until it moves less than half a pixel, at which
+    point its search radius is halved and it starts again, until the search
+    radius is smaller than the minimum
+    @param data:
+        A 3D numpy array of thresholded stamps, with zeros wherever masked
+    @param mask:
+        A 3D boolean numpy array that is True wherever the data are masked
+    @param search_radius:
+        A numpy array of the initial search radius for each stamp
+    @param min_search_radius:
+        A numpy array of the smallest search radius for each stamp
+    @param kernel:
+        One of KERNELS; see locate_obj
+    @returns:
+        Three numpy arrays - the x and y of each center of mass, in the pixel
+        coordinates of the stamps, and the radius of each object; all three
+        are NaN for any stamp where no object could be found
+    """
+    n, h, w = data.shape
+    data = data.astype(data.dtype.newbyteorder('='), copy=False)
+    if kernel == 'masked':
+        moments = masked_moments(data, mask)
+    elif kernel == 'weights':
+        moments = weighted_moments(data, mask)
+    else:
+        raise ValueError("Unknown centroid kernel: {}".format(kernel))
+    
+    x_cen, y_cen = np.full(n, h/2.0), np.full(n, w/2.0)
+    old_x_cen, old_y_cen = np.full(n, -np.inf), np.full(n, -np.inf)
+    radius = np.full(n, np.nan)
+    search_radius = search_radius.copy()
+    
+    # stamps that are entirely masked have no object
+    failed = mask.reshape(n, -1).all(axis=1)
+    active = np.logical_not(failed)
+    
+    while True:
+        # stamps that have converged move on to the next search radius, or stop
+        moved = np.hypot(x_cen-old_x_cen, y_cen-old_y_cen)
+        converged = active & ~(moved >= 0.5)
+        while np.any(converged):
+            search_radius[converged] /= 2
+            active[converged & (search_radius < min_search_radius)] = False
+            restart = converged & active
+            old_x_cen[restart], old_y_cen[restart] = -np.inf, -np.inf
+            converged = restart & ~(np.hypot(x_cen-old_x_cen,
+                                             y_cen-old_y_cen) >= 0.5)
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        
+        # calculate some moments and stuff for the stamps that are still going
+        mom1x, mom1y, mom0, area = moments(idx, x_cen[idx], y_cen[idx],
+                                           search_radius[idx])
+        
+        # a stamp with no mass left in its aperture has no object
+        empty = (mom0 == 0)
+        failed[idx[empty]] = True
+        active[idx[empty]] = False
+        
+        # now do a center-of-mass calculation to find the size and centroid
+        good = np.logical_not(empty)
+        idx = idx[good]
+        old_x_cen[idx], old_y_cen[idx] = x_cen[idx], y_cen[idx]
+        x_cen[idx] = mom1x[good]/mom0[good]
+        y_cen[idx] = mom1y[good]/mom0[good]
+        radius[idx] = np.sqrt(area[good]/np.pi)
+    
+    x_cen[failed], y_cen[failed], radius[failed] = np.nan, np.nan, np.nan
+    return x_cen, y_cen, radius
+
+
+def masked_moments(data, mask):
+    """
+    Build a function that measures the moments of some of the stamps in a
+    stack within circular apertures, in exactly the same way as the original
+    numpy.ma calculation: the distances are computed with np.hypot, and the
+    moments are summed over full-size products
+    @param data:
+        A 3D numpy array of thresholded stamps, with zeros wherever masked
+    @param mask:
+        A 3D boolean numpy array that is True wherever the data are masked
+    @returns:
+        A function that takes the indices of the stamps to measure, followed by
+        numpy arrays of their aperture centers x and y and radii, and returns
+        numpy arrays of their first x moments, first y moments, zeroth
+        moments, and areas
+    """
+    n, h, w = data.shape
+    x_arr, y_arr, r_arr = index_grids((h, w))
+    
+    # allocate everything that the loop needs ahead of time
+    dx_buf, dy_buf = np.empty((n, 1, w)), np.empty((n, h, 1))
+    dist_buf = np.empty((n, h, w))
+    mask_buf = np.empty((n, h, w), dtype=bool)
+    data_buf = np.empty((n, h, w), dtype=data.dtype)
+    prod_buf = np.empty((n, h, w), dtype=np.result_type(data, x_arr))
+    sign_buf = np.empty((n, h, w), dtype=data.dtype)
+    
+    def moments(idx, x_cen, y_cen, search_radius):
+        # mask each stamp outside of its aperture, reusing the same buffers
+        k = idx.size
+        dx, dy, dist = dx_buf[:k], dy_buf[:k], dist_buf[:k]
+        local_mask, local_data = mask_buf[:k], data_buf[:k]
+        np.subtract(x_arr[np.newaxis,:1,:], x_cen[:,np.newaxis,np.newaxis],
+                    out=dx)
+        np.subtract(y_arr[np.newaxis,:,:1], y_cen[:,np.newaxis,np.newaxis],
+                    out=dy)
+        np.hypot(dx, dy, out=dist)
+        np.greater(dist, search_radius[:,np.newaxis,np.newaxis],
+                   out=local_mask)
+        if k == n:
+            np.logical_or(local_mask, mask, out=local_mask)
+            np.copyto(local_data, data)
+        else:
+            np.logical_or(local_mask, mask[idx], out=local_mask)
+            np.take(data, idx, axis=0, out=local_data)
+        np.copyto(local_data, 0, where=local_mask)
+        
+        mom1x = np.multiply(local_data, x_arr, out=prod_buf[:k]).sum(axis=(1,2))
+        mom1y = np.multiply(local_data, y_arr, out=prod_buf[:k]).sum(axis=(1,2))
+        mom0 = local_data.sum(axis=(1,2)).astype(float)
+        area = np.sign(local_data, out=sign_buf[:k]).sum(axis=(1,2))
+        return mom1x, mom1y, mom0, area.astype(float)
+    
+    return moments
+
+
+def weighted_moments(data, mask):
+    """
+    Build a function that measures the moments of some of the stamps in a
+    stack within circular apertures, using the aperture as a weight array and
+    never forming products with the index grids: the apertured stamps are
+    summed along rows and columns, and the first moments are the dot products
+    of those sums with the pixel indices
+    @param data:
+        A 3D numpy array of thresholded stamps, with zeros wherever masked
+    @param mask:
+        A 3D boolean numpy array that is True wherever the data are masked
+    @returns:
+        A function like the one returned by masked_moments
+    """
+    n, h, w = data.shape
+    x_arr, y_arr, r_arr = index_grids((h, w))
+    x_idx, y_idx = x_arr[0].astype(float), y_arr[:,0].astype(float)
+    positive = (data > 0).astype(data.dtype)
+    
+    # allocate everything that the loop needs ahead of time
+    dx2_buf, dy2_buf = np.empty((n, 1, w)), np.empty((n, h, 1))
+    dist2_buf = np.empty((n, h, w))
+    weight_buf = np.empty((n, h, w), dtype=data.dtype)
+    data_buf = np.empty((n, h, w), dtype=data.dtype)
+    
+    def moments(idx, x_cen, y_cen, search_radius):
+        k = idx.size
+        dx2, dy2, dist2 = dx2_buf[:k], dy2_buf[:k], dist2_buf[:k]
+        weight, local_data = weight_buf[:k], data_buf[:k]
+        np.square(x_idx - x_cen[:,np.newaxis], out=dx2[:,0,:])
+        np.square(y_idx - y_cen[:,np.newaxis], out=dy2[:,:,0])
+        np.add(dx2, dy2, out=dist2)
+        np.less_equal(dist2, np.square(search_radius)[:,np.newaxis,np.newaxis],
+                      out=weight)
+        if k == n:
+            np.multiply(data, weight, out=local_data)
+            area = np.einsum('kij,kij->k', positive, weight)
+        else:
+            np.multiply(data[idx], weight, out=local_data)
+            area = np.einsum('kij,kij->k', positive[idx], weight)
+        
+        col_sums = local_data.sum(axis=1, dtype=np.float64)
+        row_sums = local_data.sum(axis=2, dtype=np.float64)
+        mom0 = col_sums.sum(axis=1)
+        return np.dot(col_sums, x_idx), np.dot(row_sums, y_idx), mom0, area
+    
+    return moments
+
+
+def windowed_centroids(stamps, min_search_radius=None, thresh=3,
+                       kernel='masked'):
+    """
+    The 'window' algorithm: starting from the center of mass, repeatedly
+    recenter a gaussian window on the background-subtracted data, in the same
+    way as SExtractor's windowed positions. This uses every pixel rather than
+    only the ones above the threshold, so it holds up better on faint objects
+    @param stamps:
+        A list of tuples, as returned by cut_stamp
+    @param min_search_radius:
+        The expected radius of the objects, which sets the width of the
+        window, or None to use the radius found by the center of mass
+    @param thresh:
+        The threshold for the initial center of mass
+    @param kernel:
+        The kernel for the initial center of mass
+    @returns:
+        A numpy array of three columns: the x, y, and radius of each object
+    """
+    output = com_centroids(stamps, min_search_radius, thresh=thresh,
+                           kernel=kernel)
+    for shape, idx in group_by_shape(stamps).items():
+        idx = np.array([i for i in idx if np.all(np.isfinite(output[i]))])
+        if idx.size == 0:
+            continue
+        x_arr, y_arr, r_arr = index_grids(shape)
+        x_idx, y_idx = x_arr[0].astype(float), y_arr[:,0].astype(float)
+        data = np.array([subtract_background(stamps[i]) for i in idx])
+        x0 = np.array([stamps[i][2] for i in idx], dtype=float)
+        y0 = np.array([stamps[i][3] for i in idx], dtype=float)
+        x_start = output[idx,0] - x0 + 0.5
+        y_start = output[idx,1] - y0 + 0.5
+        if min_search_radius == None:
+            sigma = np.maximum(output[idx,2]/2, 0.5)
+        else:
+            sigma = np.full(idx.size, min_search_radius/2.0)
+        
+        # the window is separable, so only its rows and columns are computed
+        x_cen, y_cen = x_start.copy(), y_start.copy()
+        for i in range(MAX_WINDOW_ITER):
+            dx = x_idx - x_cen[:,np.newaxis]
+            dy = y_idx - y_cen[:,np.newaxis]
+            wx = np.exp(-dx**2/(2*sigma[:,np.newaxis]**2))
+            wy = np.exp(-dy**2/(2*sigma[:,np.newaxis]**2))
+            mom0 = np.einsum('kij,ki,kj->k', data, wy, wx)
+            mom1x = np.einsum('kij,ki,kj->k', data, wy, wx*dx)
+            mom1y = np.einsum('kij,ki,kj->k', data, wy*dy, wx)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                shift_x, shift_y = 2*mom1x/mom0, 2*mom1y/mom0
+            shift_x[~(mom0 > 0)], shift_y[~(mom0 > 0)] = 0, 0
+            x_cen += shift_x
+            y_cen += shift_y
+            if np.all(np.hypot(shift_x, shift_y) < WINDOW_TOL):
+                break
+        
+        # anything that wandered off of its object goes back to where it began
+        lost = ~(np.hypot(x_cen-x_start, y_cen-y_start) <= 2*sigma)
+        x_cen[lost], y_cen[lost] = x_start[lost], y_start[lost]
+        output[idx,0] = x0 + x_cen - 0.5
+        output[idx,1] = y0 + y_cen - 0.5
+    return output
+
+
+def gaussian_fit_centroids(stamps, min_search_radius=None, thresh=3,
+                           kernel='masked'):
+    """
+    The 'gaussian' algorithm: a least-squares fit of a circular 2D gaussian
+    plus a constant background, starting from the center of mass
+    @param stamps:
+        A list of tuples, as returned by cut_stamp
+    @param min_search_radius:
+        The expected radius of the objects, which sets the size of the region
+        that is fit, or None to use the radius found by the center of mass
+    @param thresh:
+        The threshold for the initial center of mass
+    @param kernel:
+        The kernel for the initial center of mass
+    @returns:
+        A numpy array of three columns: the x, y, and half width at half
+        maximum of each object
+    """
+    return fit_centroids(stamps, 'gaussian', min_search_radius, thresh=thresh,
+                         kernel=kernel)
+
+
+def moffat_fit_centroids(stamps, min_search_radius=None, thresh=3,
+                         kernel='masked'):
+    """
+    The 'moffat' algorithm: a least-squares fit of a circular moffat profile,
+    whose wings are broader than a gaussian's like those of a seeing-limited
+    star, plus a constant background, starting from the center of mass
+    @param stamps:
+        A list of tuples, as returned by cut_stamp
+    @param min_search_radius:
+        The expected radius of the objects; see gaussian_fit_centroids
+    @param thresh:
+        The threshold for the initial center of mass
+    @param kernel:
+        The kernel for the initial center of mass
+    @returns:
+        A numpy array of three columns: the x, y, and half width at half
+        maximum of each object
+    """
+    return fit_centroids(stamps, 'moffat', min_search_radius, thresh=thresh,
+                         kernel=kernel)
+
+
+def fit_centroids(stamps, profile, min_search_radius=None, thresh=3,
+                  kernel='masked'):
+    """
+    Fit a radial profile to the unmasked pixels near each object. Any fit that
+    fails or runs away from its object falls back to the center of mass
+    @param stamps:
+        A list of tuples, as returned by cut_stamp
+    @param profile:
+        Either 'gaussian' or 'moffat'
+    @param min_search_radius:
+        The expected radius of the objects, or None to use the radius found by
+        the center of mass
+    @param thresh:
+        The threshold for the initial center of mass
+    @param kernel:
+        The kernel for the initial center of mass
+    @returns:
+        A numpy array of three columns: the x, y, and half width at half
+        maximum of each object
+    """
+    output = com_centroids(stamps, min_search_radius, thresh=thresh,
+                           kernel=kernel)
+    for i, (raw, mask, x0, y0, search_radius) in enumerate(stamps):
+        if not np.all(np.isfinite(output[i])):
+            continue
+        if min_search_radius == None:
+            size = output[i,2]
+        else:
+            size = float(min_search_radius)
+        x_start, y_start = output[i,0] - x0 + 0.5, output[i,1] - y0 + 0.5
+        
+        # pick out the pixels to fit
+        x_arr, y_arr, r_arr = index_grids(raw.shape)
+        window = np.hypot(x_arr-x_start, y_arr-y_start) <= FIT_WINDOW*size
+        window &= ~mask
+        x, y = x_arr[window], y_arr[window]
+        z = raw[window].astype(float)
+        if z.size < 8:
+            continue
+        background = np.median(raw[~mask])
+        
+        if profile == 'gaussian':
+            def residuals(p):
+                r2 = (x-p[1])**2 + (y-p[2])**2
+                return p[0]*np.exp(-r2/(2*p[3]**2)) + p[4] - z
+            def jacobian(p):
+                r2 = (x-p[1])**2 + (y-p[2])**2
+                e = np.exp(-r2/(2*p[3]**2))
+                ae = p[0]*e/p[3]**2
+                return np.array([e, ae*(x-p[1]), ae*(y-p[2]), ae*r2/p[3],
+                                 np.ones_like(e)])
+            p0 = [z.max()-background, x_start, y_start, size/2, background]
+        elif profile == 'moffat':
+            def residuals(p):
+                r2 = (x-p[1])**2 + (y-p[2])**2
+                return p[0]*(1 + r2/p[3]**2)**-p[4] + p[5] - z
+            def jacobian(p):
+                r2 = (x-p[1])**2 + (y-p[2])**2
+                u = 1 + r2/p[3]**2
+                m = u**-p[4]
+                am = 2*p[0]*p[4]*m/u/p[3]**2
+                return np.array([m, am*(x-p[1]), am*(y-p[2]), am*r2/p[3],
+                                 -p[0]*m*np.log(u), np.ones_like(m)])
+            p0 = [z.max()-background, x_start, y_start, size/2, MOFFAT_BETA,
+                  background]
+        else:
+            raise ValueError("Unknown profile: {}".format(profile))
+        
+        with np.errstate(all='ignore'):
+            p, cov, info, msg, status = optimize.leastsq(residuals, p0,
+                    Dfun=jacobian, col_deriv=True, maxfev=MAX_FIT_CALLS,
+                    full_output=True)
+        if status not in (1, 2, 3, 4) or not np.all(np.isfinite(p)):
+            continue
+        if np.hypot(p[1]-x_start, p[2]-y_start) > size or p[0] <= 0:
+            continue
+        
+        if profile == 'gaussian':
+            hwhm = abs(p[3])*np.sqrt(2*np.log(2))
+        else:
+            hwhm = abs(p[3])*np.sqrt(2**(1/p[4]) - 1)
+        output[i] = (x0 + p[1] - 0.5, y0 + p[2] - 0.5, hwhm)
+    return output
+
+
+def hole_edge_centroids(stamps, min_search_radius=None, thresh=3,
+                        kernel='masked'):
+    """
+    The 'hole' algorithm, for the holes in mask images: starting from the
+    center of mass, find where the brightness crosses halfway between the
+    inside and outside of the hole along a fan of rays, and fit a circle to
+    those points. This only looks at the edge, so it is not thrown off by
+    uneven illumination inside the hole
+    @param stamps:
+        A list of tuples, as returned by cut_stamp
+    @param min_search_radius:
+        The smallest radius for the initial center of mass
+    @param thresh:
+        The threshold for the initial center of mass
+    @param kernel:
+        The kernel for the initial center of mass
+    @returns:
+        A numpy array of three columns: the x, y, and radius of each hole
+    """
+    output = com_centroids(stamps, min_search_radius, thresh=thresh,
+                           kernel=kernel)
+    for i, (raw, mask, x0, y0, search_radius) in enumerate(stamps):
+        if not np.all(np.isfinite(output[i])):
+            continue
+        x_cen, y_cen = output[i,0] - x0 + 0.5, output[i,1] - y0 + 0.5
+        radius = output[i,2]
+        for j in range(EDGE_ITER):
+            edge = find_edge(raw, mask, x_cen, y_cen, radius, search_radius)
+            if edge is None:
+                break
+            x_cen, y_cen, radius = fit_circle(*edge)
+            output[i] = (x0 + x_cen - 0.5, y0 + y_cen - 0.5, radius)
+    return output
+
+
+def find_edge(raw, mask, x_cen, y_cen, radius, max_radius):
+    """
+    Look along rays out from the middle of a hole for the points where the
+    brightness crosses halfway between the inside and the outside
+    @param raw:
+        The 2D numpy array of the stamp
+    @param mask:
+        The 2D boolean numpy array that is True wherever the stamp is masked
+    @param x_cen:
+        The x coordinate of the approximate center, in stamp indices
+    @param y_cen:
+        The y coordinate of the approximate center, in stamp indices
+    @param radius:
+        The approximate radius of the hole
+    @param max_radius:
+        The farthest from the center to look
+    @returns:
+        Two numpy arrays of the x and y coordinates of the edge points, or None
+        if too few could be found to fit a circle
+    """
+    x_arr, y_arr, r_arr = index_grids(raw.shape)
+    dist = np.hypot(x_arr-x_cen, y_arr-y_cen)
+    inside = raw[~mask & (dist <= radius/2)]
+    outside = raw[~mask & (dist >= 1.5*radius)]
+    if inside.size == 0 or outside.size == 0:
+        return None
+    level_in, level_out = np.median(inside), np.median(outside)
+    if level_in == level_out:
+        return None
+    
+    # sample the stamp along each ray, flipped so that the hole is positive
+    theta = np.linspace(0, 2*np.pi, NUM_RAYS, endpoint=False)[:,np.newaxis]
+    t = np.arange(0, min(2*radius, max_radius), 0.5)[np.newaxis,:]
+    coords = [y_cen + t*np.sin(theta), x_cen + t*np.cos(theta)]
+    profiles = ndimage.map_coordinates(raw.astype(float), coords, order=1,
+                                       cval=np.nan)
+    blocked = ndimage.map_coordinates(mask.astype(np.uint8), coords, order=0,
+                                      cval=1)
+    profiles[blocked.astype(bool)] = np.nan
+    profiles = np.sign(level_in-level_out)*(profiles - (level_in+level_out)/2)
+    
+    # find the first crossing on every ray that reaches one without a gap
+    with np.errstate(invalid='ignore'):
+        below = profiles < 0
+    first = np.argmax(below, axis=1)
+    rows = np.arange(NUM_RAYS)
+    gaps = np.cumsum(np.isnan(profiles), axis=1)[rows, first]
+    good = below[rows, first] & (first > 0) & (gaps == 0)
+    if np.count_nonzero(good) < 8:
+        return None
+    rows, first = rows[good], first[good]
+    before, after = profiles[rows, first-1], profiles[rows, first]
+    t_edge = t[0,first-1] + 0.5*before/(before-after)
+    return (x_cen + t_edge*np.cos(theta[rows,0]),
+            y_cen + t_edge*np.sin(theta[rows,0]))
+
+
+def fit_circle(x, y):
+    """
+    Fit a circle to some points by linear least squares, then refit it once
+    without any points that are far off of it
+    @param x:
+        A numpy array of the x coordinates of the points
+    @param y:
+        A numpy array of the y coordinates of the points
+    @returns:
+        The x and y of the center of the circle, and its radius
+    """
+    for i in range(2):
+        a = np.column_stack((2*x, 2*y, np.ones_like(x)))
+        (x_cen, y_cen, c), _, _, _ = np.linalg.lstsq(a, x**2 + y**2, rcond=-1)
+        radius = np.sqrt(c + x_cen**2 + y_cen**2)
+        residuals = np.hypot(x-x_cen, y-y_cen) - radius
+        spread = 1.4826*np.median(np.abs(residuals))
+        keep = np.abs(residuals) <= 3*spread + 1e-3
+        if keep.all() or np.count_nonzero(keep) < 8:
+            break
+        x, y = x[keep], y[keep]
+    return x_cen, y_cen, radius
+
+
+def subtract_background(stamp):
+    """
+    Subtract the median of the unmasked pixels from a stamp, and zero the
+    masked ones
+    @param stamp:
+        A tuple, as returned by cut_stamp
+    @returns:
+        The float64 numpy array of the background-subtracted stamp
+    """
+    raw, mask = stamp[:2]
+    data = raw.astype(float)
+    if not mask.all():
+        data -= np.median(raw[~mask])
+    data[mask] = 0
+    return data
+
+
+def group_by_shape(stamps):
+    """
+    Sort a list of stamps by the shapes of their arrays, so that stamps of the
+    same shape can be stacked
+    @param stamps:
+        A list of tuples whose first elements are 2D numpy arrays
+    @returns:
+        A dictionary mapping each shape to a list of the indices of the stamps
+        of that shape
+    """
+    shapes = {}
+    for i, stamp in enumerate(stamps):
+        shapes.setdefault(stamp[0].shape, []).append(i)
+    return shapes
+
+
+def index_grids(shape):
+    """
+    Get the x and y index of every pixel in a cutout of a certain shape, along
+    with each pixel's distance from the point where the centroiding starts.
+    These are computed once for each shape and then cached, so they are
+    read-only
+    @param shape:
+        The shape of the cutout, as a tuple of two ints
+    @returns:
+        Three 2D numpy arrays of the given shape - the x indices, the y
+        indices, and the distances
+    """
+    try:
+        return GRID_CACHE[shape]
+    except KeyError:
+        yx = np.indices(shape)
+        x_arr, y_arr = yx[1], yx[0]
+        r_arr = np.hypot(x_arr - shape[0]/2.0, y_arr - shape[1]/2.0)
+        for arr in (x_arr, y_arr, r_arr):
+            arr.flags.writeable = False
+        GRID_CACHE[shape] = (x_arr, y_arr, r_arr)
+        return GRID_CACHE[shape]
+
+
+class ArrayImage(object):
+    """
+    A stand-in for a ginga AstroImage that wraps a plain numpy array, so that
+    the centroiding can be run without ginga
+    """
+    
+    def __init__(self, data):
+        """
+        Class constructor
+        @param data:
+            The 2D numpy array to wrap
+        """
+        self.data = data
+        self.height, self.width = data.shape
+    
+    
+    def cutout_adjust(self, x1, y1, x2, y2):
+        """
+        Cut out a box of data, shifting it to be inside the image if necessary,
+        the same way as ginga.BaseImage.cutout_adjust
+        @returns:
+            The cut out numpy array, and the adjusted bounds x1, y1, x2, y2
+        """
+        dx, dy = x2 - x1, y2 - y1
+        if x1 < 0:
+            x1, x2 = 0, dx
+        elif x2 >= self.width:
+            x2 = self.width
+            x1 = x2 - dx
+        if y1 < 0:
+            y1, y2 = 0, dy
+        elif y2 >= self.height:
+            y2 = self.height
+            y1 = y2 - dy
+        return (self.data[int(y1):int(y2), int(x1):int(x2)], x1, y1, x2, y2)
+
+
+class StampCube(object):
+    """
+    The cutouts around a set of objects, copied once into one contiguous 3D
+    array. It can stand in for the image that it was cut from: cutout_adjust
+    returns read-only views into the cube for the boxes that it was built from,
+    and passes any other box on to the image
+    """
+    
+    def __init__(self, image, bounds_list):
+        """
+        Class constructor
+        @param image:
+            The AstroImage to cut the objects out of
+        @param bounds_list:
+            A nonempty sequence of bounds tuples, as taken by locate_obj
+        """
+        self.image = image
+        cutouts = [image.cutout_adjust(*bounds[:4]) for bounds in bounds_list]
+        
+        # cutouts at the edges may be a different size, so leave room for all
+        self.data = np.zeros((len(cutouts),
+                              max([c[0].shape[0] for c in cutouts]),
+                              max([c[0].shape[1] for c in cutouts])),
+                             dtype=cutouts[0][0].dtype)
+        for i, cutout in enumerate(cutouts):
+            h, w = cutout[0].shape
+            self.data[i,:h,:w] = cutout[0]
+        self.data.flags.writeable = False
+        
+        self.cutouts = []
+        self.index = {}
+        for i, cutout in enumerate(cutouts):
+            h, w = cutout[0].shape
+            self.cutouts.append((self.data[i,:h,:w],) + tuple(cutout[1:]))
+            self.index.setdefault(tuple(bounds_list[i][:4]), i)
+    
+    
+    def get_cutout(self, i):
+        """
+        Get the cutout of one of the objects
+        @param i:
+            The index of the object in the bounds_list
+        @returns:
+            The view of its data in the cube, and its adjusted bounds x1, y1,
+            x2, y2, the same as ginga.BaseImage.cutout_adjust
+        """
+        return self.cutouts[i]
+    
+    
+    def cutout_adjust(self, x1, y1, x2, y2):
+        """
+        Cut out a box of data, from the cube if it is one of the objects' boxes
+        or from the image if not
+        @returns:
+            The cut out numpy array, and the adjusted bounds x1, y1, x2, y2
+        """
+        try:
+            return self.cutouts[self.index[(x1, y1, x2, y2)]]
+        except KeyError:
+            return self.image.cutout_adjust(x1, y1, x2, y2)
+
+
+def synthetic_field(num_objs=40, size=30, sigma=1.5, noise=1.0, seed=0,
+                    profile='gaussian', peak=(20, 200)):
+    """
+    Make an image of a grid of stars or mask holes at random subpixel
+    positions, with random brightnesses and gaussian noise
+    @param num_objs:
+        The number of objects
+    @param size:
+        The apothem of the box around each object, as in MESLocate.square_size
+    @param sigma:
+        The standard deviation of each gaussian star, the width parameter of
+        each moffat star, or the radius of each hole, in pixels
+    @param noise:
+        The standard deviation of the noise
+    @param seed:
+        The seed for the random number generator
+    @param profile:
+        Either 'gaussian' or 'moffat' for stars, or 'hole' for uniformly lit
+        holes with slightly blurred edges
+    @param peak:
+        The range of peak brightnesses of the objects, in units of the noise
+    @returns:
+        An ArrayImage, a list of bounds tuples as taken by locate_obj, and a
+        numpy array of the true position of each object in the coordinates
+        that locate_obj returns
+    """
+    rng = np.random.RandomState(seed)
+    cols = int(np.ceil(np.sqrt(num_objs)))
+    spacing = 2*size + 10
+    data = rng.normal(0, noise, ((num_objs//cols+1)*spacing,
+                                 cols*spacing)).astype(np.float32)
+    
+    bounds, truth = [], []
+    for i in range(num_objs):
+        bx, by = (i%cols)*spacing + 5, (i//cols)*spacing + 5
+        x = bx + size + rng.uniform(-size/4.0, size/4.0)
+        y = by + size + rng.uniform(-size/4.0, size/4.0)
+        yy, xx = np.mgrid[by:by+2*size, bx:bx+2*size]
+        r2 = (xx-x)**2 + (yy-y)**2
+        if profile == 'gaussian':
+            shape = np.exp(-r2/(2*sigma**2))
+        elif profile == 'moffat':
+            shape = (1 + r2/sigma**2)**-MOFFAT_BETA
+        elif profile == 'hole':
+            shape = ndimage.gaussian_filter((r2 <= sigma**2).astype(float), 1)
+        else:
+            raise ValueError("Unknown profile: {}".format(profile))
+        data[by:by+2*size, bx:bx+2*size] += rng.uniform(*peak)*noise*shape
+        bounds.append((bx, by, bx+2*size, by+2*size, 1.42*size))
+        truth.append((x - 0.5, y - 0.5))
+    return ArrayImage(data), bounds, np.array(truth)
+
+
+def benchmark(num_objs=40, trials=5):
+    """
+    Run both benchmark_kernels and benchmark_algorithms
+    @param num_objs:
+        The number of objects in each field
+    @param trials:
+        The number of times to time each calculation
+    """
+    benchmark_kernels(num_objs, trials=trials)
+    print
+    benchmark_algorithms(num_objs, trials=trials)
+
+
+def benchmark_kernels(num_objs=40, size=30, trials=5):
+    """
+    Time each centroid kernel on a synthetic field, and report how far its
+    results are from the 'masked' kernel's and from the true positions
+    @param num_objs:
+        The number of stars in the field
+    @param size:
+        The apothem of the box around each star
+    @param trials:
+        The number of times to time each kernel
+    """
+    image, bounds, truth = synthetic_field(num_objs, size)
+    masks = [[]]*num_objs
+    reference = locate_objs(bounds, masks, image, min_search_radius=4)
+    
+    print "{:>10} {:>12} {:>12} {:>14} {:>12}".format(
+            "kernel", "batch (ms)", "single (ms)", "vs masked (px)",
+            "error (px)")
+    for kernel in KERNELS:
+        start = time.time()
+        for i in range(trials):
+            result = locate_objs(bounds, masks, image, min_search_radius=4,
+                                 kernel=kernel)
+        batch_time = (time.time() - start)/trials
+        
+        start = time.time()
+        for i in range(trials):
+            for j in range(num_objs):
+                locate_obj(bounds[j], masks[j], image, min_search_radius=4,
+                           kernel=kernel)
+        single_time = (time.time() - start)/trials
+        
+        difference = np.nanmax(np.hypot(*(result - reference)[:,:2].T))
+        error = np.nanmean(np.hypot(*(result[:,:2] - truth).T))
+        print "{:>10} {:>12.2f} {:>12.2f} {:>14.2g} {:>12.3f}".format(
+                kernel, 1000*batch_time, 1000*single_time, difference, error)
+
+
+def benchmark_algorithms(num_objs=40, trials=5, tolerance=0.1):
+    """
+    Time each centroid algorithm on synthetic stamps like the ones that each
+    mode sees, report how far its results are from the true positions, and
+    recommend the fastest one whose mean error is within the tolerance
+    @param num_objs:
+        The number of objects in each field
+    @param trials:
+        The number of times to time each algorithm
+    @param tolerance:
+        The largest acceptable mean error in pixels
+    """
+    cases = [   # mode, description, synthetic_field arguments, object size
+        ('star', "gaussian stars",
+         dict(size=30, profile='gaussian', sigma=1.5), 4),
+        ('star', "moffat stars",
+         dict(size=30, profile='moffat', sigma=2.5), 4),
+        ('starhole', "faint stars",
+         dict(size=20, profile='gaussian', sigma=1.5, peak=(5, 20)), 4),
+        ('mask', "mask holes",
+         dict(size=60, profile='hole', sigma=15), 20),
+    ]
+    
+    row = "{:>9} {:>15} {:>9} {:>12.3f} {:>11.3f} {:>11.3f} {:>7}"
+    print "{:>9} {:>15} {:>9} {:>12} {:>11} {:>11} {:>7}".format(
+            "mode", "objects", "algorithm", "ms per obj", "mean (px)",
+            "90% (px)", "failed")
+    for mode, description, kwargs, obj_size in cases:
+        image, bounds, truth = synthetic_field(num_objs, **kwargs)
+        masks = [[]]*num_objs
+        best = None
+        for algorithm in ALGORITHMS:
+            start = time.time()
+            for i in range(trials):
+                result = locate_objs(bounds, masks, image,
+                                     min_search_radius=obj_size,
+                                     algorithm=algorithm)
+            obj_time = (time.time() - start)/trials/num_objs
+            
+            error = np.hypot(*(result[:,:2] - truth).T)
+            failed = np.count_nonzero(np.isnan(error))
+            error = error[np.isfinite(error)]
+            if error.size > 0:
+                mean, pct = np.mean(error), np.percentile(error, 90)
+            else:
+                mean, pct = np.nan, np.nan
+            print row.format(mode, description, algorithm, 1000*obj_time,
+                             mean, pct, failed)
+            if mean <= tolerance and failed == 0:
+                if best == None or obj_time < best[1]:
+                    best = (algorithm, obj_time)
+        
+        if best != None:
+            print "{:>9} {:>15} fastest within {} px: {}".format(
+                    mode, description, tolerance, best[0])
+        else:
+            print "{:>9} {:>15} nothing is within {} px".format(
+                    mode, description, tolerance)
+
+
+if __name__ == '__main__':
+    benchmark()
+
+#END
+
@@ -8,16 +8,26 @@
 
 
 # standard imports
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
+import tempfile
+import threading
 
 # third-party imports
 from astropy.io import fits
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter
 
+# local imports
+from util import cacheUtils
+from util import irafUtils
+
 
 # constants
 DIR_MCSRED = '../../MCSRED2/'
+DIR_SCRATCH = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None  # tmpfs
 NO_SUCH_FILE_ERR = ("No such file or directory: {}\nPlease check your frame "+
                         "numbers and image directory, or run Ginga from a "+
                         "different directory.")
@@ -25,8 +35,17 @@ WRONG_CHIP_ERR =   ("{} should be data from chip {}, but is from chip {}. Try "+
                         "a different frame number.")
 LOW_ELEV_WARN =   (u"{}MCSA{:08d}.fits has low elevation of {:.1f}\u00B0; the "+
                         "mosaicing database may not be applicable here.")
+WRONG_MASK_SIZE_ERR = ("{} is a {}x{} mask, but the image it should mask is "+
+                        "{}x{}. Please check your configuration file.")
+WRONG_SHAPE_ERR =  ("{} is a {} image, but {} is {}. These frames cannot be "+
+                        "subtracted.")
 USER_INTERRUPT_ERR = ("This process was terminated. Please press 'Return to "+
                         "Menu' to start it over.")
+CACHED_MOSAIC_MSG = ("These frames have been processed before with the same "+
+                        "configuration. Loading the saved mosaic...")
+MOSAIC_CACHE_SIZE = 16   # the number of processed mosaics to keep in the cache
+MOSAIC_VERSION = 1       # increment whenever the mosaics come out differently
+IRAF_LOCK = threading.Lock()    # held by every pyraf call; it is not threadsafe
 
 
 
@@ -55,8 +74,8 @@ def auto_process_fits(mode, n1, n2, c, i, f, t, log=nothing, next_step=None):
 
 
 def process_star_fits(star_num, back_num, c_file, img_dir, output_filename,
-                      terminate, log=nothing, next_step=None
-                      ):
+                      terminate, log=nothing, next_step=None, fuse=True,
+                      use_iraf=False):
     """
     Process the raw star and background images by subtracting the background
     from the star images, adding a gaussian filter to the result, and mosaicing
@@ -78,7 +97,12 @@ def process_star_fits(star_num, back_num, c_file, img_dir, output_filename,
         A function which should take one argument, and will be called to report
         information
     @param next_step:
-        The function to be called at the end of this process
+        The function to be called at the end of this process, which should
+        accept the mosaic numpy array and its astropy.io.fits.Header
+    @param fuse:
+        Whether make_mosaic should resample each chip only once
+    @param use_iraf:
+        Whether make_mosaic should call IRAF instead of the native methods
     @raises IOError:
         If it cannot find the FITS files in the specified directory
     @raises ValueError:
@@ -86,47 +110,63 @@ def process_star_fits(star_num, back_num, c_file, img_dir, output_filename,
     """
     log("Processing star frames...")
     
-    # open the star FITS and check header info
+    # open all of the FITS files and check their headers before reading data
+    filenames = ["{}MCSA{:08d}.fits".format(img_dir, star_num+i)
+                 for i in (0, 1)]
     star_chip = []
     for i in (0, 1):
-        star_chip.append(open_fits("{}MCSA{:08d}.fits".format(
-                                            img_dir, star_num+i), i+1))
+        star_chip.append(open_fits(filenames[i], i+1))
+    if back_num != 0:
+        filenames += ["{}MCSA{:08d}.fits".format(img_dir, back_num+i)
+                      for i in (0, 1)]
+        back_chip = []
+        for i in (0, 1):
+            back_chip.append(open_fits(filenames[i+2], i+1))
+            check_shapes(star_chip[i], back_chip[i])
+    
+    for i in (0, 1):
         if star_chip[i].header['ALTITUDE'] < 45.0:
             log(LOW_ELEV_WARN.format(img_dir, star_num+i,
                                      star_chip[i].header['ALTITUDE']),
                 level='warning')
     
-    # subtract the background frames from the star frames
-    log("Subtracting images...")
+    # skip the rest if nothing has changed since these were last processed
+    key = mosaic_key('star', filenames, c_file, fuse, use_iraf)
+    if use_cached_mosaic(key, output_filename, log, next_step):
+        return
+    
+    # subtract the background frames from the star frames as each chip starts
     if back_num != 0:
-        back_chip = []
-        for i in (0, 1):
-            back_chip.append(open_fits("{}MCSA{:08d}.fits".format(
-                                                img_dir, back_num+i), i+1))
-        
-        dif_data = [star_chip[i].data - back_chip[i].data for i in (0,1)]
+        def subtract(i):
+            log("Subtracting images on chip {}...".format(i+1))
+            return np.subtract(star_chip[i].data, back_chip[i].data,
+                               dtype=np.float32)
+        dif_data = [lambda: subtract(0), lambda: subtract(1)]
     
     else:
-        dif_data = [star_chip[i].data for i in (0,1)]
+        dif_data = [lambda: star_chip[0].data, lambda: star_chip[1].data]
     
     # mosaic the chips together
     if terminate.is_set():  return
-    mosaic_data = make_mosaic(dif_data, c_file, terminate, log=log)
+    mosaic_data = make_mosaic(dif_data, c_file, terminate, log=log,
+                              fuse=fuse, use_iraf=use_iraf)
     if terminate.is_set():  return
     
     # apply gaussian blur
     log("Blurring...")
     mosaic_data = gaussian_filter(mosaic_data, 1.0)
     
-    # write to file and go to next_step
-    fits.writeto(output_filename, mosaic_data, header=star_chip[0].header,
-                 clobber=True)
+    # archive to file in the background and go to next_step
+    header = star_chip[0].header.copy()
+    write_fits_async(output_filename, mosaic_data, header, log=log,
+                     cache_key=key)
     if next_step != None:
-        next_step()
+        next_step(mosaic_data, header)
 
 
 def process_mask_fits(mask_num, c_file, img_dir, output_filename,
-                      terminate, log=nothing, next_step=None):
+                      terminate, log=nothing, next_step=None, fuse=True,
+                      use_iraf=False):
     """
     Process the raw mask frames by changing their data type and mosaicing them
     together
@@ -144,37 +184,53 @@ def process_mask_fits(mask_num, c_file, img_dir, output_filename,
     @param log:
         The function that will be called whenever something interesting happens
     @param next_step:
-        The function to be called at the end of this process
+        The function to be called at the end of this process, which should
+        accept the mosaic numpy array and its astropy.io.fits.Header
+    @param fuse:
+        Whether make_mosaic should resample each chip only once
+    @param use_iraf:
+        Whether make_mosaic should call IRAF instead of the native methods
     @raises IOError:
         If it cannot find the FITS images
     """
     log("Processing mask frames...")
     
     # load the files
+    filenames = ["{}MCSA{:08d}.fits".format(img_dir, mask_num+chip)
+                 for chip in (0, 1)]
     mask_chip = []
     for chip in (0, 1):
-        mask_chip.append(open_fits("{}MCSA{:08d}.fits".format(
-                                            img_dir, mask_num+chip), chip+1))
+        mask_chip.append(open_fits(filenames[chip], chip+1))
+    
+    # skip the rest if nothing has changed since these were last processed
+    key = mosaic_key('mask', filenames, c_file, fuse, use_iraf)
+    if use_cached_mosaic(key, output_filename, log, next_step):
+        return
     
     # mosaic the reformatted results to a file
     if terminate.is_set():  return
-    mosaic_data = make_mosaic([hdu.data for hdu in mask_chip], c_file,
-                              terminate, log=log)
+    mosaic_data = make_mosaic([lambda: mask_chip[0].data,
+                               lambda: mask_chip[1].data], c_file,
+                              terminate, log=log, fuse=fuse, use_iraf=use_iraf)
     if terminate.is_set():  return
     
-    # finish up by writing to file and moving on
-    fits.writeto(output_filename, mosaic_data, header=mask_chip[0].header,
-                 clobber=True)
+    # finish up by archiving to file in the background and moving on
+    header = mask_chip[0].header.copy()
+    write_fits_async(output_filename, mosaic_data, header, log=log,
+                     cache_key=key)
     if next_step != None:
-        next_step()
+        next_step(mosaic_data, header)
 
 
-def make_mosaic(input_data, c_file, terminate, log=nothing):
+def make_mosaic(input_data, c_file, terminate, log=nothing, fuse=True,
+                use_iraf=False, parallel=True):
     """
     Correct the images for distortion, and then combine the two FITS images by
     rotating and stacking them vertically. Also do something to the header
     @param input_data:
-        A sequence of two numpy 2D arrays to mosaic together
+        A sequence of two numpy 2D arrays to mosaic together, or of two
+        functions that take no arguments and return them, in which case each
+        function is called as the first stage of its chip's processing
     @param c_file:
         The location of the configuration .cfg file that manages distortion-
         correction
@@ -182,10 +238,59 @@ def make_mosaic(input_data, c_file, terminate, log=nothing):
         The threading.Event object that will tell us when/if to terminate
     @param log:
         A function that takes a single string argument and records it somehow
+    @param fuse:
+        Whether to combine both distortion corrections into a single
+        resampling of each chip, instead of interpolating each chip twice
+    @param use_iraf:
+        Whether to use IRAF for the transforms and masks; IRAF cannot fuse
+        them, so this implies fuse=False
+    @param parallel:
+        Whether to process the two chips at the same time in separate threads
     @returns:
         A mosaiced numpy array comprising data from the two input_data arrays
     """
     # read MSCRED c_file
+    config = read_config(c_file)
+    
+    if terminate.is_set():  return
+    
+    # each chip is independent until they are combined
+    chip_config = [([(config[2], config[3]), (config[8], config[9])],
+                    config[12]),
+                   ([(config[4], config[5]), (config[10], config[11])],
+                    config[13])]
+    def process_chip(i):
+        return correct_chip(input_data[i], chip_config[i][0],
+                            chip_config[i][1], terminate, log=log,
+                            fuse=fuse, use_iraf=use_iraf, chipnum=i+1)
+    
+    if parallel:
+        pool = ThreadPool(2)
+        try:
+            mosaic_data = pool.map(process_chip, (0, 1))
+        finally:
+            pool.close()
+    else:
+        mosaic_data = [process_chip(i) for i in (0, 1)]
+    if terminate.is_set():  return
+    
+    # combine and rotate the images
+    log("Combining the chips...")
+    mosaic_arr = np.rot90(np.sum(mosaic_data, axis=0), k=3)
+    if terminate.is_set():  return
+    
+    return mosaic_arr
+
+
+def read_config(c_file):
+    """
+    Read the values out of an MCSRED configuration file
+    @param c_file:
+        The location of the configuration .cfg file
+    @returns:
+        A list of the last word on each line that is not a comment, with the
+        MCSRED directory variable expanded
+    """
     cfg = open(c_file, 'r')
     config = []
     line = cfg.readline()
@@ -194,42 +299,121 @@ def make_mosaic(input_data, c_file, terminate, log=nothing):
             config.append(line.split()[-1].replace('dir_mcsred$',DIR_MCSRED))
         line = cfg.readline()
     cfg.close()
+    return config
+
+
+def mosaic_key(process, input_filenames, c_file, fuse=True, use_iraf=False):
+    """
+    Build a cache key for a processed mosaic from everything that goes into it
+    @param process:
+        The name of the process that makes the mosaic - 'star' or 'mask'
+    @param input_filenames:
+        The raw FITS files that go into the mosaic
+    @param c_file:
+        The location of the configuration .cfg file
+    @param fuse:
+        The fuse argument that make_mosaic will be given
+    @param use_iraf:
+        The use_iraf argument that make_mosaic will be given
+    @returns:
+        A string that changes whenever the frame numbers, the configuration,
+        the modification time or size of any input file, the pipeline path,
+        or MOSAIC_VERSION does
+    """
+    dependencies = list(input_filenames)
+    dependencies += [f for f in read_config(c_file) if os.path.isfile(f)]
+    stats = []
+    for filename in dependencies:
+        st = os.stat(filename)
+        stats.append((os.path.abspath(filename), st.st_mtime, st.st_size))
+    path = (bool(fuse) and not use_iraf, bool(use_iraf))
+    return cacheUtils.hash_key('mosaic', MOSAIC_VERSION, process, path, stats,
+                               files=[c_file])
+
+
+def use_cached_mosaic(key, output_filename, log=nothing, next_step=None):
+    """
+    Finish a process with a previously saved mosaic, if there is one
+    @param key:
+        The cache key, as returned by mosaic_key
+    @param output_filename:
+        The filename of the output FITS image
+    @param log:
+        The function that will be called whenever something interesting happens
+    @param next_step:
+        The function to be called with the mosaic numpy array and its
+        astropy.io.fits.Header
+    @returns:
+        True if the cached mosaic was found and used, False otherwise
+    """
+    filename = cacheUtils.cache_path(key, '.fits')
+    try:
+        hdu = fits.open(filename, memmap=True)[0]
+    except IOError:
+        return False
+    cacheUtils.touch(filename)
     
-    mosaic_data = [None,None]
-    if terminate.is_set():  return
-    
-    # XXX: stuff I haven't figured out how to do wiothout IRAF yet :XXX #
-    # correct for distortion and apply mask
-    log("Correcting for distortion...")
-    mosaic_data[0] = transform(input_data[0], config[2], config[3])
-    if terminate.is_set():  return
-    mosaic_data[1] = transform(input_data[1], config[4], config[5])
-    if terminate.is_set():  return
-    
-    log("Correcting for more distortion...")
-    mosaic_data[0] = transform(mosaic_data[0], config[8], config[9])
-    if terminate.is_set():  return
-    mosaic_data[1] = transform(mosaic_data[1], config[10], config[11])
+    log(CACHED_MOSAIC_MSG)
+    write_fits_async(output_filename, hdu.data, hdu.header, log=log)
+    if next_step != None:
+        next_step(hdu.data, hdu.header)
+    return True
+
+
+def correct_chip(input_data, transforms, pl_filename, terminate, log=nothing,
+                 fuse=True, use_iraf=False, chipnum=1):
+    """
+    Run one chip through the distortion corrections and the bad pixel mask
+    @param input_data:
+        A numpy 2D array, or a function that takes no arguments and returns one
+    @param transforms:
+        A sequence of (dbs_filename, gmp_filename) tuples, in the order that
+        they should be applied
+    @param pl_filename:
+        The filename of the bad pixel mask for this chip
+    @param terminate:
+        The threading.Event object that will tell us when/if to terminate
+    @param log:
+        A function that takes a single string argument and records it somehow
+    @param fuse:
+        Whether to combine all of the transforms into a single resampling
+    @param use_iraf:
+        Whether to use IRAF for each transform and the mask, instead of fusing
+    @param chipnum:
+        The number of this chip, for the log
+    @returns:
+        The corrected numpy array, or None if terminate was set
+    """
+    if callable(input_data):
+        input_data = input_data()
     if terminate.is_set():  return
     
-    log("Masking bad pixels...")
-    mosaic_data[0] = apply_mask(mosaic_data[0], config[12])
-    if terminate.is_set():  return
-    mosaic_data[1] = apply_mask(mosaic_data[1], config[13])
-    if terminate.is_set():  return
-    # XXX: stuff I haven't figured out how to do wiothout IRAF yet :XXX #
+    # correct for distortion
+    log("Correcting chip {} for distortion...".format(chipnum))
+    if fuse and not use_iraf:
+        output = transform_chain(input_data, transforms)
+        if terminate.is_set():  return
+    else:
+        output = input_data
+        for dbs_filename, gmp_filename in transforms:
+            output = transform(output, dbs_filename, gmp_filename,
+                               use_iraf=use_iraf)
+            if terminate.is_set():  return
     
-    # combine and rotate the images
-    log("Combining the chips...")
-    mosaic_arr = np.rot90(np.sum(mosaic_data, axis=0), k=3)
+    # apply the bad pixel mask
+    log("Masking bad pixels on chip {}...".format(chipnum))
+    output = apply_mask(output, pl_filename, use_iraf=use_iraf)
     if terminate.is_set():  return
     
-    return mosaic_arr
+    return output
 
 
 def open_fits(filename, chipnum):
     """
-    It's like astropy.fits.open, but with better error handling
+    It's like astropy.fits.open, but with better error handling. Only the
+    header is read here; the pixel data are memory-mapped, and are not read
+    from disk until the data attribute is used (unless the file has BSCALE or
+    BZERO, in which case astropy scales them into memory at that point)
     @param filename:
         The name of the FITS file to be opened ('***.fits')
     @param chipnum:
@@ -242,7 +426,7 @@ def open_fits(filename, chipnum):
         if the DET-ID is not chipnum
     """
     try:
-        hdu = fits.open(filename)[0]
+        hdu = fits.open(filename, memmap=True)[0]
     except IOError as e:
         if len(filename) >= 1 and filename[0] in ('/'):
             raise IOError(NO_SUCH_FILE_ERR.format(filename))
@@ -254,11 +438,96 @@ def open_fits(filename, chipnum):
     return hdu
 
 
-# XXX: Methods that still use IRAF :XXX #
+def check_shapes(hdu1, hdu2):
+    """
+    Make sure that two HDUs will have data of the same shape, using only their
+    headers
+    @param hdu1:
+        An astropy HDU object, as returned by open_fits
+    @param hdu2:
+        Another astropy HDU object, as returned by open_fits
+    @raises ValueError:
+        if the NAXIS cards do not match
+    """
+    shapes = []
+    for hdu in (hdu1, hdu2):
+        naxis = hdu.header['NAXIS']
+        shapes.append(tuple(hdu.header['NAXIS{}'.format(i)]
+                            for i in range(1, naxis+1)))
+    if shapes[0] != shapes[1]:
+        raise ValueError(WRONG_SHAPE_ERR.format(hdu1.fileinfo()['file'].name,
+                                                'x'.join(map(str,shapes[0])),
+                                                hdu2.fileinfo()['file'].name,
+                                                'x'.join(map(str,shapes[1]))))
+
+
+def write_fits_async(filename, data, header, log=nothing, cache_key=None):
+    """
+    Start writing a FITS file in a daemon thread, so that whoever needs the
+    data can have it without waiting for the disk
+    @param filename:
+        The name of the FITS file to be written
+    @param data:
+        The numpy array to write, which should not be modified afterward
+    @param header:
+        The astropy.io.fits.Header to write with it
+    @param log:
+        The function that will be called if the file cannot be written
+    @param cache_key:
+        If this is not None, the image will also be saved to the mosaic cache
+        under this key, as returned by mosaic_key
+    @returns:
+        The threading.Thread that is doing the writing
+    """
+    thread = threading.Thread(target=write_fits,
+                              args=(filename, data, header, log, cache_key))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def write_fits(filename, data, header, log=nothing, cache_key=None):
+    """
+    Write a FITS file to a temporary name and then move it into place, so that
+    nobody ever reads a half-written image
+    @param filename:
+        The name of the FITS file to be written
+    @param data:
+        The numpy array to write
+    @param header:
+        The astropy.io.fits.Header to write with it
+    @param log:
+        The function that will be called if the file cannot be written
+    @param cache_key:
+        If this is not None, the image will also be saved to the mosaic cache
+        under this key, as returned by mosaic_key
+    """
+    if cache_key != None:
+        try:
+            cacheUtils.save_file(cacheUtils.cache_path(cache_key, '.fits'),
+                                 lambda f: fits.writeto(f, data, header=header))
+            cacheUtils.evict('.fits', MOSAIC_CACHE_SIZE)
+        except (IOError, OSError) as e:
+            log("Could not cache {}: {}".format(filename, e), level='debug')
+    
+    temp_filename = "{}.{}.tmp".format(filename,
+                                       threading.current_thread().ident)
+    try:
+        fits.writeto(temp_filename, data, header=header, clobber=True)
+        os.rename(temp_filename, filename)
+    except (IOError, OSError) as e:
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
+        log("Could not save {}: {}".format(filename, e), level='warning')
+
 
-def transform(input_arr, dbs_filename, gmp_filename):
+def transform(input_arr, dbs_filename, gmp_filename, use_iraf=False):
     """
-    Correct the input array for distortion using the given dbs and gmp
+    Correct the input array for distortion using the given dbs and gmp. The
+    native path reproduces geotran with its default parameters (linear
+    interpolation, nearest boundary extension, flux conservation), and agrees
+    with IRAF to within the float32 rounding of the sampled coordinates (under
+    1e-3 pixel), except where output pixels sample beyond the input frame
     @param input_arr:
         The input numpy array
     @param dbs_filename:
@@ -271,26 +540,38 @@ def transform(input_arr, dbs_filename, gmp_filename):
         file. Rather, the .gmp file extension does exist, and serves a log of
         purposes, but none of them have anything to do with IRAF or image
         transformations. WHYYYYYY?
+    @param use_iraf:
+        Whether to call IRAF geotran instead of resampling the array natively
     @returns:
         The corrected numpy array
     """
-    from pyraf.iraf import geotran
+    if use_iraf:
+        return transform_iraf(input_arr, dbs_filename, gmp_filename)
     
-    if os.path.exists('tempout.fits'):
-        os.remove('tempout.fits')
-    fits.PrimaryHDU(data=input_arr).writeto("tempin.fits", clobber=True)
-    print dbs_filename
-    geotran('tempin.fits', 'tempout.fits', dbs_filename, gmp_filename,
-            verbose='no')
-    output = fits.open('tempout.fits')[0].data
-    os.remove('tempin.fits')
-    os.remove('tempout.fits')
-    return output
+    coord_map = irafUtils.geotran_map(dbs_filename, gmp_filename)
+    return irafUtils.resample(input_arr, coord_map)
+
+
+def transform_chain(input_arr, transforms):
+    """
+    Correct the input array for several distortions in succession, but
+    interpolate it only once, so that the PSF is only smoothed once
+    @param input_arr:
+        The input numpy array
+    @param transforms:
+        A sequence of (dbs_filename, gmp_filename) tuples, in the order that
+        they should be applied; see transform
+    @returns:
+        The corrected numpy array
+    """
+    coord_map = irafUtils.chain_map(transforms)
+    return irafUtils.resample(input_arr, coord_map)
 
 
-def apply_mask(input_arr, pl_filename, mask_val=0):
+def apply_mask(input_arr, pl_filename, mask_val=0, use_iraf=False):
     """
-    Replace all masked pixels with zero in the input array
+    Replace all masked pixels with zero in the input array. Unless use_iraf is
+    True, this modifies input_arr in place
     @param input_arr:
         The input numpy array
     @param pl_filename:
@@ -300,20 +581,129 @@ def apply_mask(input_arr, pl_filename, mask_val=0):
         instead of an image so that no program besides IRAF can read it.
     @param mask_val:
         The value to put into all of the masked pixels
+    @param use_iraf:
+        Whether to call IRAF imcombine instead of masking the array natively
+    @returns:
+        The masked numpy array
+    @raises ValueError:
+        If the mask is not the same size as the input array
     """
-    from pyraf.iraf import imcombine
+    if use_iraf:
+        return apply_mask_iraf(input_arr, pl_filename, mask_val)
     
-    if os.path.exists('tempout.fits'):
-        os.remove('tempout.fits')
-    hdu = fits.PrimaryHDU(data=input_arr)
-    hdu.header['BPM'] = pl_filename
-    hdu.writeto('tempin.fits', clobber=True)
-    imcombine('tempin.fits', 'tempout.fits',
-              masktype='goodvalue', maskvalue=mask_val)
-    output = fits.open('tempout.fits')[0].data
-    os.remove('tempin.fits')
-    os.remove('tempout.fits')
+    mask = load_mask(pl_filename)
+    if mask.shape != input_arr.shape:
+        raise ValueError(WRONG_MASK_SIZE_ERR.format(pl_filename,
+                                                    mask.shape[1],
+                                                    mask.shape[0],
+                                                    input_arr.shape[1],
+                                                    input_arr.shape[0]))
+    np.copyto(input_arr, mask_val, where=mask)
+    return input_arr
+
+
+def load_mask(pl_filename):
+    """
+    Read a pixel list into a boolean array, caching the result on disk so that
+    each mask file only ever needs to be decoded once
+    @param pl_filename:
+        The filename of the pixel list
+    @returns:
+        A read-only numpy array that is True for every masked pixel
+    @raises IOError:
+        If the file cannot be found
+    """
+    def read_mask():
+        try:
+            return irafUtils.read_pixel_list(pl_filename)
+        except ValueError:
+            return read_mask_iraf(pl_filename)
+    
+    key = cacheUtils.hash_key('pixel_list', files=[pl_filename])
+    return cacheUtils.cached_array(key, read_mask)
+
+
+# XXX: Methods that still use IRAF :XXX #
+# (each holds IRAF_LOCK, so two chips in parallel never run IRAF at once)
+
+def transform_iraf(input_arr, dbs_filename, gmp_filename):
+    """
+    Correct the input array for distortion by calling IRAF geotran
+    @param input_arr:
+        The input numpy array
+    @param dbs_filename:
+        The filename of the IRAF database file
+    @param gmp_filename:
+        The name of the record in the database file
+    @returns:
+        The corrected numpy array
+    """
+    with IRAF_LOCK, scratch_dir() as tmp:
+        from pyraf.iraf import geotran
+        tempin = os.path.join(tmp, 'tempin.fits')
+        tempout = os.path.join(tmp, 'tempout.fits')
+        fits.PrimaryHDU(data=input_arr).writeto(tempin)
+        geotran(tempin, tempout, dbs_filename, gmp_filename, verbose='no')
+        output = fits.open(tempout, memmap=False)[0].data
+    return output
+
+
+def apply_mask_iraf(input_arr, pl_filename, mask_val=0):
+    """
+    Replace all masked pixels with zero in the input array by calling IRAF
+    imcombine
+    @param input_arr:
+        The input numpy array
+    @param pl_filename:
+        The filename of the pixel list
+    @param mask_val:
+        The value to put into all of the masked pixels
+    @returns:
+        The masked numpy array
+    """
+    with IRAF_LOCK, scratch_dir() as tmp:
+        from pyraf.iraf import imcombine
+        tempin = os.path.join(tmp, 'tempin.fits')
+        tempout = os.path.join(tmp, 'tempout.fits')
+        hdu = fits.PrimaryHDU(data=input_arr)
+        hdu.header['BPM'] = os.path.abspath(pl_filename)
+        hdu.writeto(tempin)
+        imcombine(tempin, tempout, masktype='goodvalue', maskvalue=mask_val)
+        output = fits.open(tempout, memmap=False)[0].data
+    return output
+
+
+def read_mask_iraf(pl_filename):
+    """
+    Read a pixel list that irafUtils cannot decode by having IRAF convert it
+    to FITS
+    @param pl_filename:
+        The filename of the pixel list
+    @returns:
+        A numpy array that is True for every masked pixel
+    """
+    with IRAF_LOCK, scratch_dir() as tmp:
+        from pyraf.iraf import imcopy
+        tempmask = os.path.join(tmp, 'tempmask.fits')
+        imcopy(pl_filename, tempmask, verbose='no')
+        output = fits.open(tempmask, memmap=False)[0].data != 0
     return output
 
+
+@contextmanager
+def scratch_dir():
+    """
+    Create a new, uniquely named directory for IRAF's temporary files, on tmpfs
+    if possible, and delete it with everything in it when finished. This keeps
+    concurrent IRAF calls from overwriting each other's files
+    @yields:
+        The absolute path of the directory
+    """
+    path = tempfile.mkdtemp(prefix='mesoffset_', dir=DIR_SCRATCH)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
 #END
 
@@ -0,0 +1,411 @@
+#
+# irafUtils.py -- Native readers for the IRAF files that fitsUtils depends on
+# Works in conjunction with MESOffset ginga plugin for MOS Acquisition
+#
+# Justin Kunimune
+#
+
+
+
+# third-party imports
+import numpy as np
+from scipy.ndimage.interpolation import map_coordinates
+
+# local imports
+from util import cacheUtils
+
+
+
+# constants
+CHEBYSHEV, LEGENDRE, POLYNOMIAL = 1, 2, 3   # gsurfit surface types
+XNONE, XFULL, XHALF = 0, 1, 2               # gsurfit cross-term options
+NO_SUCH_RECORD_ERR = "{} has no geomap record named '{}'."
+BAD_PIXEL_LIST_ERR = "{} is not a pixel list that can be read without IRAF."
+LL_SIGNATURE = '\x00\x00\x00\x07\xff\x9c'   # the first words of a line list
+
+
+
+def read_database(dbs_filename, record):
+    """
+    Read a single record from an IRAF geomap database file
+    @param dbs_filename:
+        The filename of the IRAF database file, as passed to geotran
+    @param record:
+        The name of the record to read, as written after 'begin' in the file
+        (i.e. the .gmp filename that geomap was given)
+    @returns:
+        A dictionary mapping each field in the record to its value. Scalar
+        fields are floats where possible and strings otherwise; surface fields
+        ('surface1', 'surface2') are two-column numpy arrays with the x fit in
+        column 0 and the y fit in column 1
+    @raises IOError:
+        If the database file cannot be read
+    @raises KeyError:
+        If there is no record by that name in the file
+    """
+    dbs = open(dbs_filename, 'r')
+    lines = dbs.readlines()
+    dbs.close()
+    
+    # find the last record by this name; IRAF gives later records priority
+    output = None
+    current = None
+    i = 0
+    while i < len(lines):
+        words = lines[i].split()
+        i += 1
+        if len(words) == 0 or words[0][0] == '#':
+            continue
+        if words[0] == 'begin':
+            current = {} if ' '.join(words[1:]) == record else None
+            if current is not None:
+                output = current
+        elif current is not None and words[0].startswith('surface'):
+            n = int(words[1])
+            current[words[0]] = np.array([[float(v) for v in line.split()]
+                                          for line in lines[i:i+n]])
+            i += n
+        elif current is not None:
+            try:
+                current[words[0]] = float(words[1])
+            except (ValueError, IndexError):
+                current[words[0]] = ' '.join(words[1:])
+    
+    if output is None:
+        raise KeyError(NO_SUCH_RECORD_ERR.format(dbs_filename, record))
+    return output
+
+
+def eval_surface(fit, x, y):
+    """
+    Evaluate a surface saved by IRAF gsurfit at the given points
+    @param fit:
+        A 1D array in the gssave format: type, xorder, yorder, xterms, xmin,
+        xmax, ymin, ymax, and then the coefficients
+    @param x:
+        A numpy array of x coordinates
+    @param y:
+        A numpy array of y coordinates, broadcastable against x
+    @returns:
+        A numpy array of surface values, with the broadcast shape of x and y
+    @raises ValueError:
+        If the surface type is not one gsurfit writes
+    """
+    stype, xorder, yorder, xterms = [int(v) for v in fit[:4]]
+    xmin, xmax, ymin, ymax = fit[4:8]
+    if stype not in (CHEBYSHEV, LEGENDRE, POLYNOMIAL):
+        raise ValueError("Unknown gsurfit surface type {}".format(stype))
+    
+    # lay the coefficients out in a yorder-by-xorder matrix, the way gsurfit
+    # walks them: x varies fastest, and cross-terms can cut each row short
+    coeff = np.zeros((yorder, xorder))
+    maxorder = max(xorder, yorder) + 1
+    xincr = xorder
+    k = 8
+    for j in range(yorder):
+        coeff[j, :xincr] = fit[k:k+xincr]
+        k += xincr
+        if xterms == XNONE:
+            xincr = 1
+        elif xterms == XHALF and j + xorder + 2 > maxorder:
+            xincr -= 1
+    
+    # contract x first so that separable grids only ever touch 1D arrays
+    xbasis = basis_functions(x, xorder, stype, xmin, xmax)
+    ybasis = basis_functions(y, yorder, stype, ymin, ymax)
+    output = 0.
+    for j in range(yorder):
+        if np.any(coeff[j]):
+            output = output + ybasis[j]*sum(c*b for c, b in
+                                            zip(coeff[j], xbasis) if c != 0)
+    shape = np.broadcast(x, y).shape
+    if np.shape(output) != shape:
+        output = output*np.ones(shape)
+    return output
+
+
+def basis_functions(x, order, stype, xmin, xmax):
+    """
+    Compute the one-dimensional gsurfit basis functions at the given points
+    @param x:
+        A numpy array of coordinates
+    @param order:
+        The number of basis functions to compute
+    @param stype:
+        The surface type: CHEBYSHEV, LEGENDRE, or POLYNOMIAL
+    @param xmin, xmax:
+        The range over which the surface was fit; used to normalize the
+        coordinates for the orthogonal polynomials
+    @returns:
+        A list of order numpy arrays, each with the shape of x
+    """
+    x = np.asarray(x, dtype=float)
+    if stype != POLYNOMIAL:
+        x = (2*x - (xmax + xmin))/(xmax - xmin)
+    
+    output = [np.ones(x.shape), x]
+    for n in range(2, order):
+        if stype == CHEBYSHEV:
+            output.append(2*x*output[n-1] - output[n-2])
+        elif stype == LEGENDRE:
+            output.append(((2*n-1)*x*output[n-1] - (n-1)*output[n-2])/n)
+        else:
+            output.append(x*output[n-1])
+    return output[:order]
+
+
+def geotran_map(dbs_filename, gmp_filename, cache=True):
+    """
+    Compute the coordinate map that geotran would use for the given transform
+    with its default parameters: output limits taken from the geomap fit,
+    xscale = yscale = 1, and fluxconserve = yes
+    @param dbs_filename:
+        The filename of the IRAF database file
+    @param gmp_filename:
+        The name of the record in the database file
+    @param cache:
+        Whether to reuse a map saved on disk by a previous call with the same
+        database contents, and to save this one if there is none
+    @returns:
+        A float32 array of shape (3, nlines, ncols). Layers 0 and 1 are the
+        0-indexed row and column in the input array that each output pixel
+        samples, and layer 2 is the Jacobian of the transformation, which
+        geotran multiplies into each pixel to conserve flux. If cache is True,
+        this will be a read-only memory map
+    @raises KeyError:
+        If the database has no such record
+    """
+    if cache:
+        key = cacheUtils.hash_key('geotran_map', gmp_filename,
+                                  files=[dbs_filename])
+        return cacheUtils.cached_array(key, lambda: geotran_map(
+                                dbs_filename, gmp_filename, cache=False))
+    
+    record = read_database(dbs_filename, gmp_filename)
+    xsurf = [record[name][:,0] for name in ('surface1', 'surface2')
+                                                        if name in record]
+    ysurf = [record[name][:,1] for name in ('surface1', 'surface2')
+                                                        if name in record]
+    
+    # the output image spans the reference coordinates that geomap fit
+    xmin, xmax, ymin, ymax = xsurf[0][4:8]
+    ncols = int(round(xmax - xmin)) + 1
+    nlines = int(round(ymax - ymin)) + 1
+    xref = xmin + np.arange(ncols, dtype=float)[np.newaxis,:]
+    yref = ymin + np.arange(nlines, dtype=float)[:,np.newaxis]
+    
+    # geotran adds the linear and residual surfaces together
+    xin = sum(eval_surface(fit, xref, yref) for fit in xsurf)
+    yin = sum(eval_surface(fit, xref, yref) for fit in ysurf)
+    
+    output = np.empty((3, nlines, ncols), dtype=np.float32)
+    output[0] = yin - 1     # IRAF pixels are 1-indexed
+    output[1] = xin - 1
+    output[2] = jacobian(xin, yin)
+    return output
+
+
+def chain_map(transforms, cache=True):
+    """
+    Compute a single coordinate map equivalent to applying several geotran
+    transforms one after another, so that an image only has to be
+    interpolated once
+    @param transforms:
+        A sequence of (dbs_filename, gmp_filename) tuples, in the order that
+        they would be applied
+    @param cache:
+        Whether to reuse a map saved on disk by a previous call with the same
+        database contents, and to save this one if there is none
+    @returns:
+        A float32 array of the form returned by geotran_map
+    @raises KeyError:
+        If one of the databases has no such record
+    """
+    if cache:
+        key = cacheUtils.hash_key('chain_map', [gmp for dbs, gmp in transforms],
+                                  files=[dbs for dbs, gmp in transforms])
+        return cacheUtils.cached_array(key, lambda: chain_map(transforms,
+                                                              cache=False))
+    
+    output = geotran_map(*transforms[0])
+    for dbs_filename, gmp_filename in transforms[1:]:
+        output = compose_maps(output, geotran_map(dbs_filename, gmp_filename))
+    return output
+
+
+def compose_maps(first_map, second_map):
+    """
+    Combine two coordinate maps into one. Resampling with the result is like
+    resampling with first_map, and then resampling that with second_map
+    @param first_map:
+        The map that would be applied first, as returned by geotran_map
+    @param second_map:
+        The map that would be applied second, as returned by geotran_map
+    @returns:
+        A float32 array of the form returned by geotran_map, with the shape of
+        second_map. Both maps are smooth, so interpolating first_map at the
+        points that second_map samples is accurate to well under 1e-3 pixel.
+        Points that second_map samples outside of first_map's output are
+        extended from its edge, as they would be by the intermediate image
+    """
+    output = np.empty(second_map.shape, dtype=np.float32)
+    for i in range(3):
+        map_coordinates(first_map[i], second_map[:2], output=output[i],
+                        order=1, mode='nearest', prefilter=False)
+    output[2] *= second_map[2]
+    return output
+
+
+def jacobian(xin, yin):
+    """
+    Compute the Jacobian determinant of a gridded coordinate transformation
+    @param xin:
+        A 2D numpy array of input x coordinates, one per output pixel
+    @param yin:
+        A 2D numpy array of input y coordinates, one per output pixel
+    @returns:
+        A 2D numpy array of the area of input pixels covered by each output
+        pixel
+    """
+    dxdy, dxdx = np.gradient(xin)
+    dydy, dydx = np.gradient(yin)
+    return np.abs(dxdx*dydy - dxdy*dydx)
+
+
+def resample(input_arr, coord_map, fluxconserve=True):
+    """
+    Resample an image onto the output grid of a coordinate map, using bilinear
+    interpolation and nearest-pixel boundary extension like geotran
+    @param input_arr:
+        The input numpy array
+    @param coord_map:
+        An array of the form returned by geotran_map
+    @param fluxconserve:
+        Whether to multiply the output by the Jacobian of the transformation
+    @returns:
+        The resampled float32 numpy array, with the shape of the map
+    """
+    output = map_coordinates(input_arr, coord_map[:2], output=np.float32,
+                             order=1, mode='nearest', prefilter=False)
+    if fluxconserve:
+        output *= coord_map[2]
+    return output
+
+def read_pixel_list(pl_filename):
+    """
+    Decode an IRAF pixel list (.pl) mask file. The file is a small header and
+    title followed by the mask as PLIO saves it: the mask descriptor, encoded
+    as a line list, then the index of image lines, also encoded as a line
+    list, then the buffer of line lists that the index points into
+    @param pl_filename:
+        The filename of the pixel list
+    @returns:
+        A numpy array of booleans: True wherever the mask is nonzero
+    @raises IOError:
+        If the file cannot be read
+    @raises ValueError:
+        If the file is not in a format that this can decode
+    """
+    pl = open(pl_filename, 'rb')
+    raw = pl.read()
+    pl.close()
+    
+    # skip past the header and title to the encoded mask descriptor
+    start = raw.find(LL_SIGNATURE)
+    if start < 0:
+        raise ValueError(BAD_PIXEL_LIST_ERR.format(pl_filename))
+    buf = np.frombuffer(raw[start:len(raw)-(len(raw)-start)%2], dtype='>i2')
+    buf = buf.astype(int)
+    
+    try:
+        # the descriptor holds the dimensions, and then comes the line index
+        hdr_len = line_list_length(buf)
+        descriptor = decode_line_list(buf[:hdr_len])
+        naxes = descriptor[1]
+        axlen = descriptor[2:2+naxes]
+        idx_len = line_list_length(buf[hdr_len:])
+        ncols, nlines = axlen[0], int(np.prod(axlen[1:]))
+        index = decode_line_list(buf[hdr_len:hdr_len+idx_len], nlines)
+        llbuf = buf[hdr_len+idx_len:]
+        
+        # decode each distinct line list once; identical lines share one
+        mask = np.zeros((nlines, ncols), dtype=bool)
+        lines = {}
+        for j in range(nlines):
+            offset = index[j]
+            if offset not in lines:
+                ll = llbuf[offset:]
+                ll = ll[:line_list_length(ll)]
+                lines[offset] = decode_line_list(ll, ncols) != 0
+            mask[j] = lines[offset]
+    except IndexError:
+        raise ValueError(BAD_PIXEL_LIST_ERR.format(pl_filename))
+    
+    if naxes > 2:
+        mask = mask.reshape(tuple(axlen[::-1]))
+    return mask
+
+
+def line_list_length(ll):
+    """
+    Read the length of a PLIO line list from its header
+    @param ll:
+        A 1D array of the shorts in the line list, and possibly whatever
+        follows it
+    @returns:
+        The number of shorts in the line list, including the header
+    """
+    if ll[2] > 0:       # the old three-word header
+        return ll[2]
+    else:
+        return (ll[4] << 15) + ll[3]
+
+
+def decode_line_list(ll, npix=None):
+    """
+    Expand a PLIO line list into the pixel values that it encodes, following
+    IRAF's pl_l2pi
+    @param ll:
+        A 1D array of the shorts in the line list
+    @param npix:
+        The number of pixels to decode; if None, all of them are decoded
+    @returns:
+        A 1D numpy array of integer pixel values
+    """
+    if ll[2] > 0:       # the old three-word header
+        length, ip = ll[2], 3
+    else:
+        length, ip = (ll[4] << 15) + ll[3], ll[1]
+    
+    output = []
+    pv = 1
+    while ip < length:
+        opcode, data = ll[ip] >> 12, ll[ip] & 4095
+        ip += 1
+        if opcode == 0:         # ZN: a run of zeros
+            output.extend([0]*data)
+        elif opcode == 1:       # SH: set the high value from two words
+            pv = (ll[ip] << 12) + data
+            ip += 1
+        elif opcode == 2:       # IH: increment the high value
+            pv += data
+        elif opcode == 3:       # DH: decrement the high value
+            pv -= data
+        elif opcode == 4:       # HN: a run of high values
+            output.extend([pv]*data)
+        elif opcode == 5:       # PN: a run of zeros ending in a high value
+            if data > 0:
+                output.extend([0]*(data-1) + [pv])
+        elif opcode == 6:       # IS: increment and store one high value
+            pv += data
+            output.append(pv)
+        elif opcode == 7:       # DS: decrement and store one high value
+            pv -= data
+            output.append(pv)
+    
+    if npix is not None:
+        output = output[:npix] + [0]*(npix-len(output))
+    return np.array(output, dtype=int)
+
+#END
+
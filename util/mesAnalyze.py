@@ -17,10 +17,16 @@ from ginga.util import plots
 # third-party imports
 import numpy as np
 
+# local imports
+from util import solverUtils
+
 
 
 # constants
 VALUE_NAMES = (("dX","pix"), ("dY","pix"), ("dPA",u"\u00B0"))
+VECTOR_SCALE = 300  # the factor by which residual vectors are drawn enlarged
+VECTOR_TOL = 1.0    # the distance a vector tip must move before it is redrawn
+VECTOR_TAG = 'residuals'    # the canvas tag of the layer of residual vectors
 
 
 
@@ -41,7 +47,8 @@ class MESAnalyze(object):
     
     
     
-    def start(self, star_pos, hole_pos, next_step=None):
+    def start(self, star_pos, hole_pos, next_step=None, rejection='worst',
+              max_residual=solverUtils.MAX_RESIDUAL):
         """
         Analyze the data from MESLocate
         @param star_pos:
@@ -52,10 +59,16 @@ class MESAnalyze(object):
             The string that will be used for all temporary filenames
         @param next_step:
             The function to call when this process is done
+        @param rejection:
+            The way to find outliers, one of solverUtils.REJECTIONS
+        @param max_residual:
+            The largest residual in pixels that a point may have to be kept
         """
         # set attributes
         self.data, self.active = parse_data(star_pos, hole_pos)
         self.next_step = next_step
+        self.rejection = rejection
+        self.max_residual = max_residual
         
         # set the mouse controls
         self.set_callbacks()
@@ -107,8 +120,7 @@ class MESAnalyze(object):
         """
         distance_from_click = np.hypot(self.data[:,0] - x, self.data[:,1] - y)
         idx = np.argmin(distance_from_click)
-        self.active[idx] = val
-        self.update_plots()
+        self.set_point_active(idx, val)
     
     
     def toggle_active_x_cb(self, e):
@@ -146,10 +158,9 @@ class MESAnalyze(object):
         # adjust self.active accordinly
         idx = np.argmin(distance_from_click)
         if event.button == 1:
-            self.active[idx] = True
+            self.set_point_active(idx, True)
         elif event.button == 3:
-            self.active[idx] = False
-        self.update_plots()
+            self.set_point_active(idx, False)
     
     
     def finish_cb(self, *args):
@@ -167,45 +178,116 @@ class MESAnalyze(object):
         @returns:
             The x and y residuals in numpy array form
         """
-        data = self.data[np.nonzero(self.active)]
-        
-        # calculate the optimal transformation from the input data
-        centroid = np.mean(data, axis=0)
-        data = data - centroid
-        p_i = np.asmatrix(data[:, 0:2])
-        p_f = np.asmatrix(data[:, 2:4])
-        u, s, v = np.linalg.svd(p_i.T * p_f)
-        rot_mat = u * v
-        shift =  centroid[2:4] - centroid[0:2]*rot_mat
-        try:
-            theta = np.mean([math.acos(rot_mat[0,0]), math.asin(rot_mat[1,0])])
-        except ValueError:
-            theta = 0
-        self.transformation = (shift[0,0], shift[0,1], theta)
-        
-        # use its results to calculate some stuff
+        xres, yres = self.fit()
+        self.render(xres, yres)
+        return xres, yres
+    
+    
+    def fit(self):
+        """
+        Calculates self.transformation from the active data, without drawing
+        anything
+        @returns:
+            The x and y residuals in numpy array form
+        """
+        self.transformation, xres, yres = solverUtils.fit(self.data,
+                                                          self.active)
+        self.solver = solverUtils.RunningFit(self.data, self.active)
+        return xres, yres
+    
+    
+    def set_point_active(self, idx, val):
+        """
+        Include or exclude one datum, refit from the running sums in
+        self.solver, and redraw only what that changed
+        @param idx:
+            The index of the datum
+        @param val:
+            The new active value for the point - should be boolean
+        """
+        if not self.solver.set_active(idx, val):
+            return
+        self.active[idx] = val
+        self.transformation = self.solver.solve()
+        xres, yres = solverUtils.get_residuals(self.data, self.transformation)
+        self.render(xres, yres, changed=idx)
+    
+    
+    def render(self, xres, yres, changed=None):
+        """
+        Graph the residuals on all plots, and draw them on the canvas
+        @param xres:
+            A numpy array of the x residual of every object
+        @param yres:
+            A numpy array of the y residual of every object
+        @param changed:
+            The index of the only object whose active value changed since the
+            last render, or None to redraw every vector
+        """
         xref = self.data[:, 0]
         yref = self.data[:, 1]
-        xin  = self.data[:, 2]
-        yin  = self.data[:, 3]
-        xcalc, ycalc = transform(xin, yin, self.transformation)
-        xres = xcalc - xref
-        yres = ycalc - yref
         
         # graph residual data on the plots
-        plot_residual(self.plots[0], xref, xres, self.active, var_name="X")
-        plot_residual(self.plots[1], yref, yres, self.active, var_name="Y")
+        plot_residual(self.plots[0], xref, xres, self.active,
+                      self.max_residual, var_name="X")
+        plot_residual(self.plots[1], yref, yres, self.active,
+                      self.max_residual, var_name="Y")
         
         # update the vectors on the canvas, as well
+        if changed == None:
+            self.draw_vectors_on_canvas(xref, yref, xres, yres)
+            self.drawn_res = np.array([xres, yres], dtype=float)
+            return
+        
+        # or just the ones that look different now: moved, recolored, or
+        # relabeled
+        old_xres, old_yres = self.drawn_res
+        magnitude = np.hypot(xres, yres)
+        old_magnitude = np.hypot(old_xres, old_yres)
+        with np.errstate(invalid='ignore'):
+            redraw = (np.hypot(xres - old_xres, yres - old_yres)
+                      * VECTOR_SCALE > VECTOR_TOL)
+            redraw |= (color_level(magnitude, self.max_residual) !=
+                       color_level(old_magnitude, self.max_residual))
+        redraw |= np.isnan(xres) != np.isnan(old_xres)
+        redraw |= (np.char.mod("%.1f", magnitude) !=
+                   np.char.mod("%.1f", old_magnitude))
+        redraw[changed] = True
+        for i in np.nonzero(redraw)[0]:
+            self.update_vector(xref[i], yref[i], xres[i], yres[i], i)
+        self.drawn_res[:, redraw] = xres[redraw], yres[redraw]
+        self.canvas.update_canvas()
+    
+    
+    def draw_vectors_on_canvas(self, xref, yref, xres, yres):
+        """
+        Replaces the layer of residual vectors on the canvas with a new one,
+        built all at once and drawn with a single redraw
+        @param xref:
+            A numpy array of the observed x coordinate of every object
+        @param yref:
+            A numpy array of the observed y coordinate of every object
+        @param xres:
+            A numpy array of the x residual of every object
+        @param yres:
+            A numpy array of the y residual of every object
+        """
+        self.vectors = []
         for i in range(0, self.data.shape[0]):
-            self.draw_vector_on_canvas(xref[i], yref[i], xres[i], yres[i], i)
+            self.vectors.append(self.dc.CompoundObject(
+                                    self.dc.Line(0, 0, 0, 0, alpha=0.7,
+                                                 arrow='end', showcap=True),
+                                    self.dc.Text(0, 0)))
+            self.update_vector(xref[i], yref[i], xres[i], yres[i], i)
         
-        return xres, yres
+        self.canvas.delete_object_by_tag(VECTOR_TAG, redraw=False)
+        self.canvas.add(self.dc.CompoundObject(*self.vectors), tag=VECTOR_TAG)
     
     
-    def draw_vector_on_canvas(self, xref, yref, xres, yres, idx):
+    def update_vector(self, xref, yref, xres, yres, idx):
         """
-        Draws the residual vector at the given point on the canvas
+        Moves and recolors the residual vector at the given point in place,
+        without redrawing the canvas
         @param xref:
             The float observed x coordinate of this object
         @param yref:
@@ -221,8 +303,8 @@ class MESAnalyze(object):
         startX = xref
         startY = yref
         if not math.isnan(xres) and not math.isnan(yres):
-            endX = startX + 300*xres
-            endY = startY + 300*yres
+            endX = startX + VECTOR_SCALE*xres
+            endY = startY + VECTOR_SCALE*yres
         else:
             endX = startX
             endY = startY
@@ -231,25 +313,20 @@ class MESAnalyze(object):
         # determine the color based on activity and magnitude
         if not self.active[idx]:
             color = 'grey'
-        elif magnitude <= 0.5:
+        elif magnitude <= self.max_residual/2.0:
             color = 'green'
-        elif magnitude <= 1.0:
+        elif magnitude <= self.max_residual:
             color = 'yellow'
         else:
             color = 'red'
         
-        # delete the old vector
-        self.canvas.delete_object_by_tag(str(idx))
-        
-        # and draw in the new one
-        self.canvas.add(self.dc.CompoundObject(
-                                self.dc.Line(startX, startY, endX, endY,
-                                             color=color, arrow='end',
-                                             showcap=True, alpha = 0.7),
-                                self.dc.Text((startX+endX)/2, (startY+endY)/2,
-                                             "{:.1f}p".format(magnitude),
-                                             color=color)),
-                        tag=str(idx))
+        # then update the arrow and its label
+        line, text = self.vectors[idx].objects
+        line.x1, line.y1, line.x2, line.y2 = startX, startY, endX, endY
+        line.color = color
+        text.x, text.y = (startX+endX)/2, (startY+endY)/2
+        text.text = "{:.1f}p".format(magnitude)
+        text.color = color
     
     
     def display_values(self):
@@ -286,22 +363,14 @@ class MESAnalyze(object):
         
     def delete_outliers(self):
         """
-        Remove any data points with residuals of absolute values greater than 1.
-        Also updates the plots
+        Remove any data points with residuals of absolute values greater than
+        self.max_residual, by the method self.rejection.
+        Also updates the plots, once the fit has settled
         """
-        active = self.active
-        
-        xres, yres = self.update_plots()
-        residual_mag = np.hypot(xres, yres)*active
-        
-        # as long as some residuals are out of bounds,
-        while np.any(residual_mag > 1):
-            # delete the point with the worst residual
-            idx = np.argmax(residual_mag)
-            active[idx] = False
-            
-            xres, yres = self.update_plots()
-            residual_mag = np.hypot(xres, yres)*active
+        self.active[:] = solverUtils.reject_outliers(self.data, self.active,
+                                                     self.rejection,
+                                                     self.max_residual)
+        self.render(*self.fit())
     
     
     def get_step(self):
@@ -369,6 +438,10 @@ class MESAnalyze(object):
                                              self.toggle_active_x_cb)
         self.plots[1].fig.canvas.mpl_connect("button_press_event",
                                              self.toggle_active_y_cb)
+        for plot in self.plots:
+            plot.fig.canvas.mpl_connect("draw_event",
+                                        lambda e, plot=plot:
+                                            cache_background(plot))
         
         # now make an HBox to hold the main controls
         box = Widgets.HBox()
@@ -471,33 +544,61 @@ def parse_data(data1, data2):
     return data, np.ones(data.shape[0], dtype=bool)
 
 
-def transform(x, y, trans):
+def plot_residual(plot, z_observe, z_residual, active,
+                  max_residual=solverUtils.MAX_RESIDUAL, var_name=""):
     """
-    Applies the given transformation to the given points
-    @param x:
-        A numpy array of x positions
-    @param y:
-        A numpy array of y positions
-    @param trans:
-        A tuple of floats: (x_shift, y_shift, rotation in degrees)
-    @returns:
-        A tuple of the new x value array and the new y value array
-        or NaN, NaN if trans was None
+    Plot the residual of this data against the real value.
+    Residual is defined as the difference between the calculated value of
+    zref and the observed value of zref. The axes, titles, and shading are
+    only drawn when the data or the threshold change or the residuals leave
+    the axes; the rest of the time, just the points are blitted onto the
+    cached background
+    @param plot:
+        A ginga.util.plots.Plot object, onto which to draw the graph
+    @param z_observe:
+        A numpy array of the observed values of this variable
+    @param z_residual:
+        A numpy array of the residuals for this variable
+    @param active:
+        A numpy array representing which data are active, and which are not
+    @param max_residual:
+        The largest residual a datum may have; anything beyond is shaded red
+    @param var_name:
+        The name of this variable, if it has one
     """
-    if trans == None:
-        return float('NaN'), float('NaN')
+    # start over if the old plot cannot show these data
+    lines = getattr(plot, 'residual_lines', None)
+    if (lines == None or not np.array_equal(plot.xdata, z_observe) or
+            plot.max_residual != max_residual or
+            not within_limits(z_residual, plot.get_axis().get_ylim())):
+        setup_residual_plot(plot, z_observe, z_residual, active, max_residual,
+                            var_name)
+        return
+    
+    # otherwise, just move the points
+    inactive = np.logical_not(active)
+    lines[0].set_data(z_observe[np.nonzero(active)],
+                      z_residual[np.nonzero(active)])
+    lines[1].set_data(z_observe[np.nonzero(inactive)],
+                      z_residual[np.nonzero(inactive)])
+    plot.ydata = z_residual
     
-    xshift, yshift, thetaR = trans
-    newX = (x - xshift)*math.cos(thetaR) - (y - yshift)*math.sin(thetaR)
-    newY = (x - xshift)*math.sin(thetaR) + (y - yshift)*math.cos(thetaR)
-    return newX, newY
+    background = getattr(plot, 'background', None)
+    if background == None:
+        plot.draw()
+        return
+    canvas = plot.fig.canvas
+    canvas.restore_region(background)
+    for line in lines:
+        plot.get_axis().draw_artist(line)
+    canvas.blit(plot.get_axis().bbox)
 
 
-def plot_residual(plot, z_observe, z_residual, active, var_name=""):
+def setup_residual_plot(plot, z_observe, z_residual, active,
+                        max_residual=solverUtils.MAX_RESIDUAL, var_name=""):
     """
-    Plot the residual of this data against the real value.
-    Residual is defined as the difference between the calculated value of
-    zref and the observed value of zref.
+    Clear a plot and draw all of it: the axes, the titles, the shading, and
+    the points, which are kept as animated artists for plot_residual to move
     @param plot:
         A ginga.util.plots.Plot object, onto which to draw the graph
     @param z_observe:
@@ -506,6 +607,8 @@ def plot_residual(plot, z_observe, z_residual, active, var_name=""):
         A numpy array of the residuals for this variable
     @param active:
         A numpy array representing which data are active, and which are not
+    @param max_residual:
+        The largest residual a datum may have; anything beyond is shaded red
     @param var_name:
         The name of this variable, if it has one
     """
@@ -521,27 +624,84 @@ def plot_residual(plot, z_observe, z_residual, active, var_name=""):
         plot.clear()
     except AttributeError:
         plot.add_axis()
-    plot.plot(active_x, active_y,
-              linestyle='None', marker='+', color='blue')
-    plot.plot(inactive_x, inactive_y,
-              linestyle='None', marker='x', color='grey',
-              xtitle="{0} Position (pixels)".format(var_name),
-              ytitle="{0} Residual (pixels)".format(var_name),
-              title="{0} Residual by {0}-axis".format(var_name))
+    ax = plot.get_axis()
+    plot.residual_lines = (
+            ax.plot(active_x, active_y, linestyle='None', marker='+',
+                    color='blue', animated=True)[0],
+            ax.plot(inactive_x, inactive_y, linestyle='None', marker='x',
+                    color='grey', animated=True)[0])
+    plot.set_titles(xtitle="{0} Position (pixels)".format(var_name),
+                    ytitle="{0} Residual (pixels)".format(var_name),
+                    title="{0} Residual by {0}-axis".format(var_name))
+    ax.grid(True)
+    for lbl in ax.xaxis.get_ticklabels():
+        lbl.set(rotation=45, horizontalalignment='right')
     plot.xdata = z_observe
     plot.ydata = z_residual
     
-    # shade in regions y > 1 and y < -1
-    xlimits = plot.get_axis().get_xlim()
-    ylimits = plot.get_axis().get_ylim()
-    plot.get_axis().fill_between(xlimits, 1, ylimits[1]+1,
-                                 color='red', alpha=0.3)
-    plot.get_axis().fill_between(xlimits, -1, ylimits[0]-1,
-                                 color='red', alpha=0.3)
-    plot.get_axis().set_xlim(left=xlimits[0], right=xlimits[1])
-    plot.get_axis().set_ylim(bottom=ylimits[0], top=ylimits[1])
-    
+    # shade in regions y > max_residual and y < -max_residual
+    xlimits = ax.get_xlim()
+    ylimits = ax.get_ylim()
+    ax.fill_between(xlimits, max_residual, ylimits[1]+max_residual,
+                    color='red', alpha=0.3)
+    ax.fill_between(xlimits, -max_residual, ylimits[0]-max_residual,
+                    color='red', alpha=0.3)
+    plot.max_residual = max_residual
+    ax.set_xlim(left=xlimits[0], right=xlimits[1])
+    ax.set_ylim(bottom=ylimits[0], top=ylimits[1])
+    
+    # cache_background will catch the draw and put the points on top
     plot.draw()
 
+
+def cache_background(plot):
+    """
+    Save everything but the points after a plot is fully drawn, so that
+    plot_residual can restore it instead of drawing it again, and then draw
+    the points, which are animated and so were left out of the full draw.
+    Should be connected to the figure canvas's draw_event
+    @param plot:
+        A ginga.util.plots.Plot object, as set up by setup_residual_plot
+    """
+    lines = getattr(plot, 'residual_lines', None)
+    if lines == None:
+        return
+    try:
+        plot.background = plot.fig.canvas.copy_from_bbox(plot.get_axis().bbox)
+    except AttributeError:  # this backend cannot blit
+        plot.background = None
+    for line in lines:
+        plot.get_axis().draw_artist(line)
+
+
+def color_level(magnitude, max_residual):
+    """
+    Sort residual magnitudes into the colors that update_vector gives active
+    vectors
+    @param magnitude:
+        A numpy array of residual magnitudes
+    @param max_residual:
+        The largest residual a datum may have
+    @returns:
+        An int numpy array: 0 for green, 1 for yellow, and 2 for red
+    """
+    return ((magnitude > max_residual/2.0).astype(int) +
+            (magnitude > max_residual))
+
+
+def within_limits(values, limits):
+    """
+    Check whether every finite value in an array is in a range
+    @param values:
+        A numpy array of floats
+    @param limits:
+        A tuple of the bottom and top of the range, in either order
+    @returns:
+        True if no finite value is outside the range, False otherwise
+    """
+    values = values[np.isfinite(values)]
+    return (values.size == 0 or
+            (np.min(values) >= min(limits) and np.max(values) <= max(limits)))
+
 #END
 
@@ -610,7 +610,7 @@ def build_control_layout(controls, callback=None):
     Build a grid full of labels on the left and input widgets on the right.
     @param controls:
         A list of dictionary where each dictionary has the keys 'name' (the
-        name of the parameter), 'type' (str, in, etc.), 'default'
+        name of the parameter), 'type' (str, int, float, or bool), 'default'
         (the starting value), 'desc' (the tooltip), possibly 'format' (puts
         labels on either side of the input), and possibly 'options' (the
         list of possible values, if type is 'combobox')
@@ -651,6 +651,13 @@ def build_control_layout(controls, callback=None):
             wdg.set_value(0)
             getters[name] = wdg.get_value
             setters[name] = wdg.set_value
+        elif param['type'] == float:
+            wdg = Widgets.SpinBox(dtype=float)
+            wdg.set_limits(0, 99999999, incr_value=0.1)
+            wdg.set_decimals(2)
+            wdg.set_value(0)
+            getters[name] = wdg.get_value
+            setters[name] = wdg.set_value
         elif param['type'] == str:
             wdg = Widgets.TextEntry(editable=True)
             wdg.set_text("")
@@ -15,13 +15,17 @@ from ginga.gw import Widgets, Viewers
 
 # third-party imports
 import numpy as np
-from numpy import ma
+
+# local imports
+from util import centroidUtils
+from util import registerUtils
 
 
 
 # constants
 SELECTION_MODES = ("Automatic", "Crop", "Mask")
 BOX_COLORS = ('green','red','blue','yellow','magenta','cyan','orange')
+POSITION_DELAY = 0.3    # how long the spinboxes must be still, in seconds
 
 
 
@@ -40,6 +44,17 @@ class MESLocate(object):
             The MESOffset plugin that this class communicates with
         """
         manager.initialise(self)
+        self.locate_count = 0       # the number of centroid requests ever made
+        self.thumbnails = []        # the viewers for the objects in this run
+        self.thumbnail_keys = []    # what each thumbnail was last drawn from
+        self.viewer_pool = []       # every thumbnail viewer ever made, and its widget
+        self.stamp_cube = None      # the cutouts of all the objects, from get_stamp_cube
+        self.stamp_cube_key = None  # the image and position that stamp_cube was cut from
+        self.spinbox_values = None  # the spinbox values set by select_point
+        
+        # the timer that waits for the spinboxes to stop changing
+        self.position_timer = self.fv.get_timer()
+        self.position_timer.set_callback('expired', self.position_timer_cb)
     
     
     
@@ -69,11 +84,16 @@ class MESLocate(object):
         self.current_obj = 0        # index of the current object
         self.drag_history = [[]]    # places we've click-dragged*
         self.drag_index = [-1]      # index of the current drag for each object
+        self.drag_masks = [[]]      # the combined bitmap of the drags up to each drag
         self.drag_start = None      # the place where we most recently began to drag
         self.obj_centroids = np.zeros(self.obj_arr.shape)    # the new obj_arr based on user input and calculations
         self.square_size =  {'star':30, 'mask':60, 'starhole':20}[mode]  # the apothem of the search regions
         self.exp_obj_size = {'star':4,  'mask':20, 'starhole':4}[mode]  # the maximum expected radius of the objects
         self.interact = interact2    # whether we should interact in step 2
+        self.mode = mode            # the kind of object we're locating
+        self.locate_gen = [None]*self.obj_num    # the latest centroid request for each object
+        self.locating = set()       # the objects whose latest centroid requests are still running
+        self.finish_pending = False # whether to finish as soon as nothing is locating
         self.next_step = next_step  # what to do when we're done
         
         # set some values based on mode
@@ -90,20 +110,31 @@ class MESLocate(object):
             self.exp_obj_size = 4
             self.square_size = np.amax(self.obj_arr[:,2])
         
-        # creates the list of thumbnails that will go in the GUI
+        # gets the list of thumbnails that will go in the GUI, reusing the ones
+        # from previous runs and only making more if there are more objects
         self.fitsimage.get_settings().set(autocut_method=autocut_method)
-        self.thumbnails = create_viewer_list(self.obj_num, self.logger)
-        self.viewer_grid.remove_all()
-        for row in range(int(math.ceil(self.obj_num/2.0))):
-            for col in range(2):
-                i = 2*row + col
-                if i < len(self.thumbnails):
-                    pic = Viewers.GingaViewerWidget(viewer=self.thumbnails[i])
-                    self.viewer_grid.add_widget(pic, row, col)
+        num_new = self.obj_num - len(self.viewer_pool)
+        if num_new > 0:
+            for viewer in create_viewer_list(num_new, self.logger):
+                pic = Viewers.GingaViewerWidget(viewer=viewer)
+                self.viewer_pool.append((viewer, pic))
+        self.thumbnails = [thumbnail for thumbnail, widget in
+                           self.viewer_pool[:self.obj_num]]
+        self.thumbnail_keys = [None]*len(self.thumbnails)
+        self.stamp_cube = None
+        
+        # only lay the grid out again if it has the wrong number of thumbnails
+        if self.viewer_grid.num_children() != self.obj_num:
+            self.viewer_grid.remove_all()
+            for i, (viewer, pic) in enumerate(self.viewer_pool[:self.obj_num]):
+                self.viewer_grid.add_widget(pic, i//2, i%2)
+                pic.show()
         
         # set the mouse controls and automatically start if this is starhole mode
         self.set_callbacks()
         self.click1_cb(self.canvas, 1, *obj0)
+        if mode != 'starhole':
+            self.auto_click1()
         self.manager.go_to_gui('find')
         if mode == 'starhole':
             self.step2_cb()
@@ -169,18 +200,49 @@ class MESLocate(object):
         self.current_obj = 0
         self.drag_history = [[]]*self.obj_num
         self.drag_index = [-1]*self.obj_num
+        self.drag_masks = [[]]*self.obj_num
         return False
     
     
+    def auto_click1(self):
+        """
+        Line the SBR pattern up with the image automatically, and click on
+        wherever that puts object 0. The click from the SBR file stays in the
+        click history, so undo returns to it
+        """
+        obj0 = registerUtils.locate_pattern(
+                                self.fitsimage.get_image().get_data(),
+                                self.obj_arr, self.exp_obj_size)
+        if obj0 != None:
+            self.click1_cb(self.canvas, 1, *obj0)
+    
+    
     def set_position_cb(self, *args):
         """
-        Respond to the spinboxes being used by essentially making a new click
+        Respond to the spinboxes being used by waiting for them to stop changing
+        """
+        self.position_timer.set(POSITION_DELAY)
+    
+    
+    def position_timer_cb(self, timer):
+        """
+        Respond to the spinboxes settling down (on the timer's thread)
+        """
+        self.fv.gui_do(self.set_position)
+    
+    
+    def set_position(self):
         """
+        Move to the position in the spinboxes by essentially making a new click,
+        unless they only changed because select_point set them
+        """
+        values = (self.spinboxes['X'].get_value(),
+                  self.spinboxes['Y'].get_value())
+        if values == self.spinbox_values:
+            return
         self.canvas.delete_object_by_tag(tag(1, self.click_index))
         self.color_index -= 1
-        self.click1_cb(None, None,
-                       self.spinboxes['X'].get_value(),
-                       self.spinboxes['Y'].get_value())
+        self.click1_cb(None, None, *values)
     
     
     def undo1_cb(self, *args):
@@ -219,6 +281,7 @@ class MESLocate(object):
         """
         Respond to back button by returning to step 1
         """
+        self.cancel_locate()
         self.manager.go_to_gui('find')
         self.set_callbacks(step=1)
         self.select_point(self.click_history[self.click_index])
@@ -228,10 +291,22 @@ class MESLocate(object):
         """
         Respond to next button or right click by proceeding to the next step
         """
+        # if the spinboxes were still settling, take their position now
+        if self.position_timer.is_set():
+            self.position_timer.clear()
+            self.set_position()
+        
         # set everything up for the first object of step 2
         self.manager.go_to_gui('centroid')
         self.set_callbacks(step=2)
-        self.select_point(self.click_history[self.click_index], True)
+        self.select_point(self.click_history[self.click_index], True,
+                          update_thumbnails=self.interact)
+        
+        # if interaction is turned off, do all the objects at once and move on
+        if not self.interact:
+            self.locate_all()
+            return
+        
         self.zoom_in_on_current_obj()
         self.mark_current_obj()
         
@@ -240,15 +315,16 @@ class MESLocate(object):
             for j in range(self.drag_index[i]+1):
                 self.draw_mask(*self.drag_history[i][j], obj_idx=i, drag_idx=j)
         
-        # if interaction is turned off, immediately go to the next object
-        if not self.interact:
-            self.next_obj_cb()
-        
         
     def prev_obj_cb(self, *args):
         """
         Respond to back button in step 2 by going back to the last object
         """
+        # if we were waiting to finish, just stay on the last object instead
+        if self.finish_pending:
+            self.finish_pending = False
+            return
+        
         # if there is no previous object, return to step 1
         if self.current_obj > 0:
             self.current_obj -= 1
@@ -262,19 +338,19 @@ class MESLocate(object):
         """
         Respond to next button or right click by proceeding to the next object
         """
+        # if we are already waiting to finish, there is nowhere to go
+        if self.finish_pending:
+            return
+        
         # if there is no next object, finish up
-        self.current_obj += 1
-        if self.current_obj >= self.obj_num:
+        if self.current_obj+1 >= self.obj_num:
             self.finish()
             return
             
         # if there is one, focus in on it
+        self.current_obj += 1
         self.zoom_in_on_current_obj()
         self.mark_current_obj()
-        
-        # if interaction is turned off, immediately go to the next object
-        if not self.interact:
-            self.next_obj_cb()
     
     
     def skip_obj_cb(self, *args):
@@ -337,6 +413,14 @@ class MESLocate(object):
                                       min(max(max(yi, yf), y1), y2),
                                       kind))
         
+        # add it to the bitmap of the drags so far
+        di = self.drag_index[co]
+        self.drag_masks[co] = self.drag_masks[co][:di] + [
+                centroidUtils.add_drag(self.get_current_mask(di-1),
+                                       self.drag_history[co][di],
+                                       self.get_current_box(),
+                                       self.get_stamp_cube())]
+        
         # shade in the outside areas and remark it
         self.draw_mask(*self.drag_history[self.current_obj][-1])
         self.mark_current_obj()
@@ -391,7 +475,8 @@ class MESLocate(object):
             self.mark_current_obj()
     
     
-    def select_point(self, point, draw_circle_masks=False):
+    def select_point(self, point, draw_circle_masks=False,
+                     update_thumbnails=True):
         """
         Set a point in step 1 as the current location of object #0,
         draws squares where it thinks all the objects are accordingly,
@@ -400,16 +485,17 @@ class MESLocate(object):
             An int tuple containing the location of object #0
         @param draw_circle_masks:
             Whether we should draw the automatic circular masks
+        @param update_thumbnails:
+            Whether we should update the little pictures of each object
         """
         # define some variables before iterating through the objects
         x, y = point
-        src_image = self.fitsimage.get_image()
         color = BOX_COLORS[self.color_index%len(BOX_COLORS)]   # cycles through all the colors
         shapes = []
-        for i, viewer in enumerate(self.thumbnails):
+        for i in range(self.obj_num):
             dx, dy, r = self.obj_arr[i]
             sq_size = self.square_size
-        
+            
             # first, draw squares and numbers
             shapes.append(self.dc.SquareBox(x+dx, y+dy, sq_size, color=color))
             shapes.append(self.dc.Text(x+dx+sq_size, y+dy,
@@ -420,24 +506,52 @@ class MESLocate(object):
                 if r <= sq_size:
                     shapes.append(empty_circle(x+dx, y+dy, r, sq_size, self.dc))
                     shapes.append(self.dc.Circle(x+dx, y+dy, r, color='white'))
-
-            # then, update the little pictures
-            x1, y1, x2, y2 = (x-sq_size+dx, y-sq_size+dy,
-                              x+sq_size+dx, y+sq_size+dy)
-            cropped_data = src_image.cutout_adjust(x1,y1,x2,y2)[0]
-            viewer.set_data(cropped_data)
-            self.fitsimage.copy_attributes(viewer,
-                                           ['transforms','cutlevels','rgbmap'])
-                                           
+        
         # draw all the squares and numbers to the canvas as one object
         self.canvas.add(self.dc.CompoundObject(*shapes),
                         tag=tag(1, self.click_index))
         
+        # then, update the little pictures once things have settled down
+        if update_thumbnails:
+            self.fv.gui_do_oneshot('MESLocate-thumbnails',
+                                   self.update_thumbnails)
+        
         # update the spinboxes
         if self.spinboxes['X'].get_value() != x:
             self.spinboxes['X'].set_value(x)
         if self.spinboxes['Y'].get_value() != y:
             self.spinboxes['Y'].set_value(y)
+        self.spinbox_values = (self.spinboxes['X'].get_value(),
+                               self.spinboxes['Y'].get_value())
+    
+    
+    def update_thumbnails(self):
+        """
+        Update the little pictures of the objects at the current position, but
+        only if they are on screen, and only the ones whose cutouts have changed
+        since they were last drawn
+        """
+        # the thumbnails are only visible in step 1
+        if self.manager.stack.get_index() != self.manager.stack_idx['find']:
+            return
+        
+        # redraw only the ones that moved
+        stamp_cube = self.get_stamp_cube()
+        rgbmap = self.fitsimage.get_rgbmap()
+        display = (self.fitsimage.get_cut_levels(),
+                   self.fitsimage.get_transforms(),
+                   id(rgbmap), rgbmap.get_hash_algorithm(),
+                   rgbmap.get_hash_size(), rgbmap.arr.tostring(),
+                   rgbmap.get_sarr().tostring())    # colormap, shift, etc.
+        for i, viewer in enumerate(self.thumbnails):
+            cutout = stamp_cube.get_cutout(i)
+            key = ((id(stamp_cube.image),) + tuple(int(v) for v in cutout[1:]) +
+                   display)
+            if key != self.thumbnail_keys[i]:
+                viewer.set_data(cutout[0])
+                self.fitsimage.copy_attributes(viewer,
+                                        ['transforms','cutlevels','rgbmap'])
+                self.thumbnail_keys[i] = key
     
     
     def draw_mask(self, xd1, yd1, xd2, yd2, kind, obj_idx=None, drag_idx=None):
@@ -497,44 +611,215 @@ class MESLocate(object):
         Puts a point and/or circle on the current object
         @param obj:
             The exact coordinates (x, y, r) of this object. If none are
-            provided, they will be calculated using locate_obj
+            provided, they will be calculated using locate_obj on a worker
+            thread, and drawn when they are ready
         """
-        # if there is already a point for this object, delete it
-        t = tag(2, self.current_obj, 'pt')
-        self.canvas.delete_object_by_tag(t)
+        # any request still running for this object is now out of date
+        co = self.current_obj
+        self.locate_count += 1
+        self.locate_gen[co] = self.locate_count
+        if obj != None:
+            self.locating.discard(co)
+            self.draw_centroid(co, obj)
+            return
         
-        # then locate and draw the point (if it exists)
-        sq_size = self.square_size
-        if obj == None:
-            co = self.current_obj
-            obj = locate_obj(self.get_current_box(),
-                             self.drag_history[co][:self.drag_index[co]+1],
-                             self.fitsimage.get_image(),
-                             min_search_radius=self.exp_obj_size,
-                             viewer=self.step2_viewer)
+        # gather up the inputs now, while they are current, and send them off
+        drag_mask = self.get_current_mask()
+        if drag_mask is None:
+            drag_mask = []
+        self.locating.add(co)
+        self.fv.nongui_do(self.locate_obj_task, co, self.locate_gen[co],
+                          self.get_current_box(), drag_mask,
+                          self.get_stamp_cube())
+    
+    
+    def locate_obj_task(self, obj_idx, gen, box, drag_mask, image):
+        """
+        Locate an object on a worker thread and post the result back to the GUI
+        thread, unless a newer request for the same object has been made since
+        @param obj_idx:
+            The index of the object
+        @param gen:
+            The number of this request, from self.locate_count
+        @param box:
+            The bounds of the object, as returned by get_current_box
+        @param drag_mask:
+            The bitmap of the drags on this object, as returned by
+            get_current_mask, or an empty list
+        @param image:
+            The AstroImage containing the object, or the StampCube cut from it
+        """
+        if not self.is_current(obj_idx, gen):
+            return
+        try:
+            stamp = centroidUtils.cut_stamp(box, drag_mask, image)
+            find_centers = centroidUtils.get_algorithm(self.mode)
+            obj = tuple(find_centers([stamp], self.exp_obj_size)[0])
+            view = centroidUtils.threshold_stamp(stamp)[0]
+        except Exception as e:
+            self.logger.error("Could not locate object {}: {}".format(
+                                                            obj_idx+1, e))
+            obj, view = (float('NaN'),)*3, None
+        self.fv.gui_do(self.locate_obj_done, obj_idx, gen, obj, view)
+    
+    
+    def is_current(self, obj_idx, gen):
+        """
+        Check whether a centroid request is still wanted; results can arrive
+        after start has set up a new, differently sized run
+        @param obj_idx:
+            The index of the object
+        @param gen:
+            The number of the request, from self.locate_count
+        @returns:
+            True if obj_idx is an object of this run and gen is its latest
+            request, False otherwise
+        """
+        return (0 <= obj_idx < len(self.locate_gen) and
+                gen == self.locate_gen[obj_idx])
+    
+    
+    def locate_obj_done(self, obj_idx, gen, obj, view):
+        """
+        Respond to a worker thread locating an object by drawing it, as long as
+        no newer request for it has been made in the meantime
+        @param obj_idx:
+            The index of the object
+        @param gen:
+            The number of this request, from self.locate_count
+        @param obj:
+            The coordinates (x, y, r) of the object
+        @param view:
+            The thresholded stamp to show in step2_viewer, or None
+        """
+        if not self.is_current(obj_idx, gen):
+            return
+        self.locating.discard(obj_idx)
+        
+        # display the new data on the viewer, if this object is still up
+        if obj_idx == self.current_obj and view is not None:
+            self.step2_viewer.get_settings().set(autocut_method='minmax')
+            self.step2_viewer.set_data(view)
+        self.draw_centroid(obj_idx, obj)
+        
+        # if we were only waiting for this to finish, finish
+        if self.finish_pending and not self.locating:
+            self.finish()
+    
+    
+    def locate_all(self):
+        """
+        Locate every object in one batch on a worker thread, without zooming
+        in on or showing any of them, and then finish; for when the user does
+        not want to interact with step 2
+        """
+        bounds_list, masks_list = [], []
+        for i in range(self.obj_num):
+            bounds_list.append(self.get_current_box(idx=i))
+            drag_mask = self.get_current_mask(idx=i)
+            masks_list.append(drag_mask if drag_mask is not None else [])
+        
+        self.locate_count += 1
+        self.locate_gen = [self.locate_count]*self.obj_num
+        self.locating.update(range(self.obj_num))
+        self.fv.nongui_do(self.locate_all_task, self.locate_count,
+                          bounds_list, masks_list, self.get_stamp_cube())
+    
+    
+    def locate_all_task(self, gen, bounds_list, masks_list, image):
+        """
+        Locate a batch of objects on a worker thread and post the results back
+        to the GUI thread
+        @param gen:
+            The number of this request, from self.locate_count
+        @param bounds_list:
+            The bounds of every object, as returned by get_current_box
+        @param masks_list:
+            The drag bitmap of every object, or empty lists
+        @param image:
+            The AstroImage containing the objects, or the StampCube cut from it
+        """
+        try:
+            obj_arr = centroidUtils.locate_objs(bounds_list, masks_list, image,
+                                        min_search_radius=self.exp_obj_size,
+                                        mode=self.mode)
+        except Exception as e:
+            self.logger.error("Could not locate objects: {}".format(e))
+            obj_arr = np.full((len(bounds_list), 3), np.nan)
+        self.fv.gui_do(self.locate_all_done, gen, obj_arr)
+    
+    
+    def locate_all_done(self, gen, obj_arr):
+        """
+        Respond to a worker thread locating a batch of objects by drawing all
+        of them at once and finishing
+        @param gen:
+            The number of this request, from self.locate_count
+        @param obj_arr:
+            A numpy array of the x, y, and r of every object
+        """
+        current = [i for i in range(self.obj_num) if self.locate_gen[i] == gen]
+        if not current:
+            return
+        for i in current:
+            self.draw_centroid(i, tuple(obj_arr[i]), redraw=False)
+            self.locating.discard(i)
+        self.canvas.update_canvas()
+        self.finish()
+    
+    
+    def cancel_locate(self):
+        """
+        Forget about every centroid request that is still running
+        """
+        self.locate_gen = [None]*self.obj_num
+        self.locating.clear()
+        self.finish_pending = False
+    
+    
+    def draw_centroid(self, obj_idx, obj, redraw=True):
+        """
+        Puts a point and/or circle on an object and records its position
+        @param obj_idx:
+            The index of the object
+        @param obj:
+            The coordinates (x, y, r) of this object, which may be NaN
+        @param redraw:
+            Whether to redraw the canvas right away
+        """
+        # if there is already a point for this object, delete it
+        t = tag(2, obj_idx, 'pt')
+        self.canvas.delete_object_by_tag(t, redraw=False)
         
         # if any of the coordinates are NaN, then a red x will be drawn in the middle
+        sq_size = self.square_size
         if True in [math.isnan(x) for x in obj]:
-            x1, y1, x2, y2, r = self.get_current_box()
+            x1, y1, x2, y2, r = self.get_current_box(idx=obj_idx)
             self.canvas.add(self.dc.Point((x1+x2)/2, (y1+y2)/2, sq_size/3,
                                           color='red', linewidth=1,
                                           linestyle='dash'),
-                            tag=t)
+                            tag=t, redraw=redraw)
         else:
             self.canvas.add(self.dc.CompoundObject(
                                     self.dc.Circle(obj[0], obj[1], obj[2],
                                                    color='green', linewidth=1),
                                     self.dc.Point(obj[0], obj[1], sq_size/3,
                                                   color='green', linewidth=1)),
-                            tag=t)
+                            tag=t, redraw=redraw)
         
-        self.obj_centroids[self.current_obj] = obj
+        self.obj_centroids[obj_idx] = obj
     
     
     def finish(self):
         """
         Finishes up and goes to the next step
         """
+        # wait for any centroids that are still being calculated
+        if self.locating:
+            self.finish_pending = True
+            return
+        self.finish_pending = False
+        
         # fix up the canvas and clear callbacks
         self.manager.clear_canvas(keep_objects=True)
         
@@ -575,6 +860,48 @@ class MESLocate(object):
         if math.isnan(r):
             r = 1.42*s
         return (xf+dx-s, yf+dy-s, xf+dx+s, yf+dy+s, r)
+    
+    
+    def get_stamp_cube(self):
+        """
+        Gets the cutouts of every object at the current position, cutting them
+        out again only if the position or the image has changed since last time
+        @returns:
+            A centroidUtils.StampCube with one cutout for each object, in order,
+            that can stand in for the image
+        """
+        image = self.fitsimage.get_image()
+        key = (id(image), self.click_history[self.click_index],
+               self.square_size)
+        if self.stamp_cube == None or self.stamp_cube_key != key:
+            self.stamp_cube = centroidUtils.StampCube(image,
+                    [self.get_current_box(idx=i) for i in range(self.obj_num)])
+            self.stamp_cube_key = key
+        return self.stamp_cube
+    
+    
+    def get_current_mask(self, drag_idx=None, idx=None):
+        """
+        Gets the bitmap of every drag on the current object up to a point
+        @precondition:
+            This method only works in step 2
+        @param drag_idx:
+            The index of the last drag to include (defaults to
+            self.drag_index for the object)
+        @param idx:
+            The object index at the instant that we need the mask (defaults to
+            self.current_obj)
+        @returns:
+            A boolean numpy array the shape of the object's cutout, as
+            returned by centroidUtils.add_drag, or None if there are no drags
+        """
+        if idx == None:
+            idx = self.current_obj
+        if drag_idx == None:
+            drag_idx = self.drag_index[idx]
+        if drag_idx < 0:
+            return None
+        return self.drag_masks[idx][drag_idx]
         
             
     def gui_list(self, orientation='vertical'):
@@ -901,102 +1228,6 @@ def create_viewer_list(n, logger=None, width=120, height=120):    # 147x147 is a
     return output
 
 
-def locate_obj(bounds, masks, image, viewer=None,
-               min_search_radius=None, thresh=3):
-    """
-    Finds the center of an object using center of mass calculation
-    @param bounds:
-        A tuple of floats x1, y1, x2, y2, r. The object should be within
-        this box
-    @param masks:
-        A list of tuples of the form (x1, y1, x2, y2, kind) where kind is either
-        'mask' or 'crop' and everything else is floats. Each tuple in masks
-        is one drag of the mouse that ommitted either its interior or its
-        exterior
-    @param image:
-        The AstroImage containing the data necessary for this calculation
-    @param viewer:
-        The viewer object that will display the new data, if desired
-    @param min_search_radius:
-        The smallest radius that this will search
-    @param thresh:
-        The number of standard deviations above the mean a data point must
-        be to be considered valid
-    @returns:
-        A tuple of two floats representing the actual location of the object
-        or a tuple of NaNs if no star could be found
-    """
-    # start by getting the raw data from the image matrix
-    raw, x0,y0,x1,y1 = image.cutout_adjust(*bounds[:4])
-    search_radius = bounds[4]
-    x_cen, y_cen = raw.shape[0]/2.0, raw.shape[1]/2.0
-    yx = np.indices(raw.shape)
-    x_arr, y_arr = yx[1], yx[0]
-    
-    # crop data to circle
-    mask_tot = np.hypot(x_arr - x_cen, y_arr - y_cen) > search_radius
-    
-    # mask data based on masks
-    for drag in masks:
-        x1, y1, x2, y2, kind = (int(drag[0])-int(x0)+1, int(drag[1])-int(y0)+1,
-                                int(drag[2])-int(x0)+1, int(drag[3])-int(y0)+1,
-                                drag[4])
-        mask = np.zeros(raw.shape, dtype=bool)
-        mask[y1:y2, x1:x2] = True
-        if kind == 'crop':
-            mask = np.logical_not(mask)
-        mask_tot = np.logical_or(mask_tot, mask)
-    
-    # apply mask, calculate threshold, normalize, and coerce data positive
-    data = ma.masked_array(raw, mask=mask_tot)
-    threshold = thresh*ma.std(data) + ma.mean(data)
-    data = data - threshold
-    data = ma.clip(data, 0, float('inf'))
-    
-    # display the new data on the viewer, if necessary
-    if viewer != None:
-        viewer.get_settings().set(autocut_method='minmax')
-        viewer.set_data(data)
-    
-    # exit if the entire screen is masked
-    if np.all(mask_tot):
-        return (float('NaN'), float('NaN'), float('NaN'))
-    
-    # iterate over progressively smaller search radii
-    if min_search_radius == None:
-        min_search_radius = search_radius/2
-    has_not_executed_yet = True
-    while search_radius >= min_search_radius or has_not_executed_yet:
-        has_not_executed_yet = False
-        old_x_cen, old_y_cen = float('-inf'), float('-inf')
-        
-        # repeat the following until you hit an assymptote:
-        while np.hypot(x_cen-old_x_cen, y_cen-old_y_cen) >= 0.5:
-            # define an array for data constrained to its search radius
-            circle_mask = np.hypot(x_arr-x_cen, y_arr-y_cen) > search_radius
-            local_data = ma.masked_array(data, mask=circle_mask)
-            
-            # calculate some moments and stuff
-            mom1x = float(ma.sum(local_data*(x_arr)))
-            mom1y = float(ma.sum(local_data*(y_arr)))
-            mom0 = float(ma.sum(local_data))
-            area = float(ma.sum(np.sign(local_data)))
-            
-            # now try a center-of-mass calculation to find the size and centroid
-            try:
-                old_x_cen = x_cen
-                old_y_cen = y_cen
-                x_cen = mom1x/mom0
-                y_cen = mom1y/mom0
-                radius = math.sqrt(area/math.pi)
-            except ZeroDivisionError:
-                return (float('NaN'), float('NaN'), float('NaN'))
-        
-        search_radius = search_radius/2
-    
-    return (x0 + x_cen - 0.5, y0 + y_cen - 0.5, radius)
-
-
 def empty_circle(x, y, r, a, dc):
     """
     Create a ginga canvas mixin (whatever that is) composed of a black
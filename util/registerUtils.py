@@ -0,0 +1,151 @@
+#
+# registerUtils.py -- A utility file for lining up the SBR pattern with an image
+# Works in conjunction with MESOffset ginga plugin for MOS Acquisition
+#
+# Justin Kunimune
+#
+
+
+
+# third-party imports
+import numpy as np
+from scipy.fftpack import next_fast_len
+
+
+
+# constants
+BINNING = 4         # the factor by which the image is binned before matching
+NOISE_CLIP = 5.0    # the number of noise sigmas at which a pixel counts fully
+
+
+
+def locate_pattern(data, positions, obj_size, binning=BINNING):
+    """
+    Find the offset at which a pattern of objects best matches an image, by
+    cross-correlating the image with a synthetic image of the pattern. The
+    image is binned and clipped so that every object counts about equally no
+    matter how bright it is, and the correlation is done with FFTs
+    @param data:
+        The 2D numpy array in which to look for the pattern
+    @param positions:
+        A numpy array whose first two columns are the x and y coordinates of
+        each object relative to the first one
+    @param obj_size:
+        The approximate radius of the objects in pixels
+    @param binning:
+        The factor by which to bin the image before correlating it
+    @returns:
+        A float tuple x, y of the most likely position of the first object in
+        the image, or None if there is nothing in the image that looks like
+        an object
+    """
+    # bin and clip the image
+    image = clip_to_noise(bin_image(data, binning))
+    if image is None:
+        return None
+    h, w = image.shape
+    
+    # lay out the pattern on a grid big enough that it never wraps onto itself
+    pos = np.asarray(positions, dtype=float)[:,:2]/binning
+    span_x = int(np.ceil(np.ptp(pos[:,0]))) + 2
+    span_y = int(np.ceil(np.ptp(pos[:,1]))) + 2
+    shape = (next_fast_len(h+span_y), next_fast_len(w+span_x))
+    template = render_pattern(pos, shape)
+    
+    # correlate them, with a gaussian the size of an object as a matched filter
+    sigma = max(float(obj_size)/binning, 1.0)
+    fy = np.fft.fftfreq(shape[0])[:,np.newaxis]
+    fx = np.fft.rfftfreq(shape[1])[np.newaxis,:]
+    spectrum = np.fft.rfft2(image, shape) * np.conj(np.fft.rfft2(template))
+    spectrum *= np.exp(-2*(np.pi*sigma)**2 * (fx**2 + fy**2))
+    corr = np.fft.irfft2(spectrum, shape)[:h, :w]    # obj0 must be in the image
+    
+    # find the peak and refine it
+    iy, ix = np.unravel_index(np.argmax(corr), corr.shape)
+    if corr[iy, ix] <= 0:
+        return None
+    dx = parabola_peak(corr[iy, ix-1:ix+2]) if 0 < ix < w-1 else 0
+    dy = parabola_peak(corr[iy-1:iy+2, ix]) if 0 < iy < h-1 else 0
+    return (binning*(ix+dx) + (binning-1)/2.0,
+            binning*(iy+dy) + (binning-1)/2.0)
+
+
+def bin_image(data, binning):
+    """
+    Average an image over square blocks of pixels, discarding any leftover
+    rows or columns at the edges
+    @param data:
+        The 2D numpy array to bin
+    @param binning:
+        The side length of each block
+    @returns:
+        The binned float32 numpy array
+    """
+    h, w = data.shape[0]//binning, data.shape[1]//binning
+    blocks = np.asarray(data)[:h*binning, :w*binning]
+    blocks = blocks.reshape(h, binning, w, binning)
+    return blocks.mean(axis=(1,3), dtype=np.float32)
+
+
+def clip_to_noise(image):
+    """
+    Rescale an image so that the background is 0 and anything more than a few
+    noise levels above it is 1
+    @param image:
+        The 2D numpy array to rescale
+    @returns:
+        The rescaled array, or None if the image has no noise to measure
+    """
+    sample = image[::4, ::4]
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return None
+    background = np.median(sample)
+    noise = 1.4826*np.median(np.abs(sample - background))
+    if not noise > 0:
+        return None
+    
+    image = (image - background)/(NOISE_CLIP*noise)
+    image[~np.isfinite(image)] = 0
+    return np.clip(image, 0, 1, out=image)
+
+
+def render_pattern(positions, shape):
+    """
+    Draw a pattern of points on a periodic grid, with the first point at the
+    origin and each point split between its four nearest pixels
+    @param positions:
+        A numpy array of two columns; the x and y of each point relative to the
+        first one
+    @param shape:
+        The shape of the grid
+    @returns:
+        A float32 numpy array of the given shape
+    """
+    template = np.zeros(shape, dtype=np.float32)
+    x, y = positions[:,0], positions[:,1]
+    x0, y0 = np.floor(x), np.floor(y)
+    fx, fy = x - x0, y - y0
+    x0, y0 = x0.astype(int), y0.astype(int)
+    for ddx, ddy, weight in ((0, 0, (1-fx)*(1-fy)), (1, 0, fx*(1-fy)),
+                             (0, 1, (1-fx)*fy),     (1, 1, fx*fy)):
+        np.add.at(template, ((y0+ddy)%shape[0], (x0+ddx)%shape[1]), weight)
+    return template
+
+
+def parabola_peak(values):
+    """
+    Find the position of the vertex of the parabola through three points
+    @param values:
+        The values at -1, 0, and 1, where the middle one is the greatest
+    @returns:
+        The offset of the vertex from the middle point, between -0.5 and 0.5
+    """
+    a, b, c = values
+    denominator = a - 2*b + c
+    if denominator >= 0:
+        return 0.0
+    return 0.5*(a - c)/denominator
+
+#END
+
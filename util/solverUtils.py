@@ -0,0 +1,427 @@
+#
+# solverUtils.py -- A utility file for fitting the rotation and shift between
+#                   the stars and the holes
+# Works in conjunction with MESOffset ginga plugin for MOS Acquisition
+#
+# Justin Kunimune
+#
+
+
+
+# standard imports
+import math
+
+# third-party imports
+import numpy as np
+
+
+
+# constants
+REJECTIONS = ('worst', 'sigma', 'ransac', 'huber')    # see reject_outliers
+MAX_RESIDUAL = 1.0      # the largest residual in pixels that an inlier may have
+SIGMA_CLIP = 3.0        # the number of rms residuals at which to sigma clip
+MAX_CLIP_ITER = 10      # the most times sigma clipping or huber will refit
+RANSAC_PAIRS = 256      # the most pairs of points that ransac will try
+RANSAC_SEED = 0         # the seed for picking ransac pairs, for repeatability
+
+
+
+def fit(data, active=None):
+    """
+    Solve for the rigid transformation that best lines up the active objects,
+    and calculate the residuals of every object under it
+    @param data:
+        A four-column numpy array of the hole positions (x, y) and the star
+        positions (x, y), as returned by mesAnalyze.parse_data
+    @param active:
+        A boolean numpy array of which objects to fit, or None to fit all of
+        them
+    @returns:
+        The transformation, as returned by solve_transform, and numpy arrays
+        of the x and y residuals of every object, as returned by get_residuals
+    """
+    trans = solve_transform(data, active)
+    xres, yres = get_residuals(data, trans)
+    return trans, xres, yres
+
+
+def solve_transform(data, active=None):
+    """
+    Find the rotation and shift that best map the holes onto the stars, in the
+    least squares sense, with a singular value decomposition
+    @param data:
+        A four-column numpy array of the hole positions and the star positions
+    @param active:
+        A boolean numpy array of which objects to use, or None to use all of
+        them
+    @returns:
+        A tuple of floats: (x_shift, y_shift, rotation in radians), or None if
+        there are no active objects
+    """
+    if active is not None:
+        data = data[np.nonzero(active)]
+    if data.shape[0] == 0:
+        return None
+    
+    # calculate the optimal transformation from the input data
+    centroid = np.mean(data, axis=0)
+    data = data - centroid
+    p_i = np.asmatrix(data[:, 0:2])
+    p_f = np.asmatrix(data[:, 2:4])
+    u, s, v = np.linalg.svd(p_i.T * p_f)
+    rot_mat = u * v
+    shift =  centroid[2:4] - centroid[0:2]*rot_mat
+    try:
+        theta = np.mean([math.acos(rot_mat[0,0]), math.asin(rot_mat[1,0])])
+    except ValueError:
+        theta = 0
+    return (shift[0,0], shift[0,1], theta)
+
+
+def get_residuals(data, trans):
+    """
+    Calculate how far each star is from its hole under a transformation
+    @param data:
+        A four-column numpy array of the hole positions and the star positions
+    @param trans:
+        A tuple of floats: (x_shift, y_shift, rotation in radians), or None
+    @returns:
+        Numpy arrays of the x and y residuals of every object, which are NaN
+        if trans is None
+    """
+    xref = data[:, 0]
+    yref = data[:, 1]
+    xin  = data[:, 2]
+    yin  = data[:, 3]
+    xcalc, ycalc = transform(xin, yin, trans)
+    return xcalc - xref, ycalc - yref
+
+
+def reject_outliers(data, active=None, method='worst',
+                    max_residual=MAX_RESIDUAL, nsigma=SIGMA_CLIP):
+    """
+    Work out which objects are outliers to the rigid transformation. 'worst'
+    drops the object with the largest residual and refits until none are
+    greater than max_residual. 'sigma' iteratively clips everything more than
+    nsigma rms residuals (and more than max_residual) off, and then drops
+    whatever is still beyond max_residual. 'ransac' fits every pair of objects
+    at once and keeps the largest set that agrees to within max_residual.
+    'huber' refits with weights that stop outliers from pulling the fit, and
+    then drops whatever is still beyond max_residual. All but 'worst' make
+    that last cut only once, so a plain refit to their inliers may leave a few
+    residuals just over max_residual
+    @param data:
+        A four-column numpy array of the hole positions and the star positions
+    @param active:
+        A boolean numpy array of which objects may be used, or None for all of
+        them
+    @param method:
+        One of REJECTIONS
+    @param max_residual:
+        The largest residual in pixels that an inlier may have
+    @param nsigma:
+        The clipping threshold for 'sigma', in rms residuals
+    @returns:
+        A new boolean numpy array of which objects are inliers
+    @raises ValueError:
+        If the method is not recognized
+    """
+    if active is None:
+        active = np.ones(data.shape[0], dtype=bool)
+    active = np.array(active, dtype=bool)
+    if method == 'worst':
+        return reject_worst(data, active, max_residual)
+    elif method == 'sigma':
+        return reject_sigma(data, active, max_residual, nsigma)
+    elif method == 'ransac':
+        return reject_ransac(data, active, max_residual)
+    elif method == 'huber':
+        return reject_huber(data, active, max_residual)
+    else:
+        raise ValueError("Unknown rejection method: {}".format(method))
+
+
+def reject_worst(data, active, max_residual):
+    """
+    Drop the object with the worst residual and refit, one at a time, until
+    every residual is small enough
+    @param data:
+        A four-column numpy array of the hole positions and the star positions
+    @param active:
+        A boolean numpy array of which objects to start with; this is modified
+    @param max_residual:
+        The largest residual that an inlier may have
+    @returns:
+        The boolean numpy array of inliers
+    """
+    xres, yres = get_residuals(data, solve_transform(data, active))
+    residual_mag = np.hypot(xres, yres)*active
+    
+    # as long as some residuals are out of bounds,
+    while np.any(residual_mag > max_residual):
+        # delete the point with the worst residual
+        idx = np.argmax(residual_mag)
+        active[idx] = False
+        
+        xres, yres = get_residuals(data, solve_transform(data, active))
+        residual_mag = np.hypot(xres, yres)*active
+    return active
+
+
+def reject_sigma(data, active, max_residual, nsigma):
+    """
+    Iteratively clip every object whose residual is more than some multiple
+    of the rms residual, letting clipped objects back in if the fit moves
+    back towards them, and then drop whatever is still beyond max_residual
+    @param data:
+        A four-column numpy array of the hole positions and the star positions
+    @param active:
+        A boolean numpy array of which objects may be used
+    @param max_residual:
+        The largest residual that an inlier may have, below which an object
+        is never clipped
+    @param nsigma:
+        The clipping threshold, in rms residuals
+    @returns:
+        The boolean numpy array of inliers
+    """
+    inliers = active.copy()
+    for i in range(MAX_CLIP_ITER):
+        if not np.any(inliers):
+            break
+        trans = solve_transforms(data, inliers[np.newaxis,:])
+        residual_mag = np.hypot(*get_residuals_batch(data, trans))[0]
+        rms = np.sqrt(np.mean(residual_mag[inliers]**2))
+        limit = max(nsigma*rms, max_residual)
+        new_inliers = active & (residual_mag <= limit)
+        if np.array_equal(new_inliers, inliers):
+            break
+        inliers = new_inliers
+    if not np.any(inliers):
+        return inliers
+    
+    # refit to what survived, and take everything that agrees with that
+    trans = solve_transforms(data, inliers[np.newaxis,:])
+    residual_mag = np.hypot(*get_residuals_batch(data, trans))[0]
+    return active & (residual_mag <= max_residual)
+
+
+def reject_ransac(data, active, max_residual):
+    """
+    Fit the transformation to many pairs of objects in one batch, take the
+    pair that agrees with the most other objects, and refit to all of those
+    @param data:
+        A four-column numpy array of the hole positions and the star positions
+    @param active:
+        A boolean numpy array of which objects may be used
+    @param max_residual:
+        The largest residual that an inlier may have
+    @returns:
+        The boolean numpy array of inliers
+    """
+    candidates = np.nonzero(active)[0]
+    n = candidates.size
+    if n < 3:
+        return reject_worst(data, active, max_residual)
+    
+    # choose the pairs; all of them, if there are few enough
+    first, second = np.triu_indices(n, 1)
+    if first.size > RANSAC_PAIRS:
+        rng = np.random.RandomState(RANSAC_SEED)
+        chosen = rng.choice(first.size, RANSAC_PAIRS, replace=False)
+        first, second = first[chosen], second[chosen]
+    weights = np.zeros((first.size, data.shape[0]))
+    rows = np.arange(first.size)
+    weights[rows, candidates[first]] = 1
+    weights[rows, candidates[second]] = 1
+    
+    # score every pair by its number of inliers, then by their residuals
+    trans = solve_transforms(data, weights)
+    residual_mag = np.hypot(*get_residuals_batch(data, trans))
+    agree = active & (residual_mag <= max_residual)
+    error = np.sum(np.where(agree, residual_mag**2, 0), axis=1)
+    best = np.lexsort((error, -np.sum(agree, axis=1)))[0]
+    inliers = agree[best]
+    if not np.any(inliers):
+        return inliers
+    
+    # refit to the consensus, and take everything that agrees with that
+    trans = solve_transforms(data, inliers[np.newaxis,:])
+    residual_mag = np.hypot(*get_residuals_batch(data, trans))[0]
+    return active & (residual_mag <= max_residual)
+
+
+def reject_huber(data, active, max_residual):
+    """
+    Refit with Huber weights, which count objects beyond max_residual less the
+    further away they are, and then drop whatever is still beyond it
+    @param data:
+        A four-column numpy array of the hole positions and the star positions
+    @param active:
+        A boolean numpy array of which objects may be used
+    @param max_residual:
+        The residual at which the weights start to fall off
+    @returns:
+        The boolean numpy array of inliers
+    """
+    if not np.any(active):
+        return active
+    weights = active.astype(float)
+    for i in range(MAX_CLIP_ITER):
+        trans = solve_transforms(data, weights[np.newaxis,:])
+        residual_mag = np.hypot(*get_residuals_batch(data, trans))[0]
+        new_weights = active*max_residual/np.maximum(residual_mag,
+                                                     max_residual)
+        if np.allclose(new_weights, weights):
+            break
+        weights = new_weights
+    return active & (residual_mag <= max_residual)
+
+
+def solve_transforms(data, weights):
+    """
+    Find the best rotation and shift for many weightings of the objects at
+    once, with one batched singular value decomposition
+    @param data:
+        A four-column numpy array of the hole positions and the star positions
+    @param weights:
+        A two-dimensional numpy array with a row of object weights for each
+        fit to do
+    @returns:
+        A three-column numpy array of (x_shift, y_shift, rotation in radians)
+        for each row of weights, computed the same way as solve_transform
+    """
+    weights = np.asarray(weights, dtype=float)
+    total = np.sum(weights, axis=1)[:,np.newaxis]
+    centroid = np.dot(weights, data)/total
+    p_i, p_f = data[:,0:2], data[:,2:4]
+    cross = (np.einsum('ki,ij,il->kjl', weights, p_i, p_f) -
+             total[:,:,np.newaxis]*np.einsum('kj,kl->kjl', centroid[:,0:2],
+                                                           centroid[:,2:4]))
+    u, s, v = np.linalg.svd(cross)
+    rot_mat = np.einsum('kij,kjl->kil', u, v)
+    shift = centroid[:,2:4] - np.einsum('kj,kjl->kl', centroid[:,0:2],
+                                                     rot_mat)
+    with np.errstate(invalid='ignore'):
+        theta = (np.arccos(rot_mat[:,0,0]) + np.arcsin(rot_mat[:,1,0]))/2
+    theta[np.isnan(theta)] = 0
+    return np.column_stack((shift, theta))
+
+
+def get_residuals_batch(data, trans):
+    """
+    Calculate the residuals of every object under many transformations
+    @param data:
+        A four-column numpy array of the hole positions and the star positions
+    @param trans:
+        A three-column numpy array of transformations, as returned by
+        solve_transforms
+    @returns:
+        Two-dimensional numpy arrays of the x and y residuals, with a row for
+        each transformation and a column for each object
+    """
+    xshift, yshift, thetaR = (trans[:,i:i+1] for i in range(3))
+    x, y = data[:,2] - xshift, data[:,3] - yshift
+    return (x*np.cos(thetaR) - y*np.sin(thetaR) - data[:,0],
+            x*np.sin(thetaR) + y*np.cos(thetaR) - data[:,1])
+
+
+def transform(x, y, trans):
+    """
+    Applies the given transformation to the given points
+    @param x:
+        A numpy array of x positions
+    @param y:
+        A numpy array of y positions
+    @param trans:
+        A tuple of floats: (x_shift, y_shift, rotation in degrees)
+    @returns:
+        A tuple of the new x value array and the new y value array
+        or NaN, NaN if trans was None
+    """
+    if trans == None:
+        return float('NaN'), float('NaN')
+    
+    xshift, yshift, thetaR = trans
+    newX = (x - xshift)*math.cos(thetaR) - (y - yshift)*math.sin(thetaR)
+    newY = (x - xshift)*math.sin(thetaR) + (y - yshift)*math.cos(thetaR)
+    return newX, newY
+
+
+class RunningFit(object):
+    """
+    The sums that the rigid transformation depends on, kept up to date as
+    objects are switched on and off, so that refitting after each switch
+    takes a constant amount of time instead of a pass over every object
+    """
+    
+    def __init__(self, data, active=None):
+        """
+        Class constructor
+        @param data:
+            A four-column numpy array of the hole positions and the star
+            positions
+        @param active:
+            A boolean numpy array of which objects to start with, or None for
+            all of them; this is copied
+        """
+        if active is None:
+            active = np.ones(data.shape[0], dtype=bool)
+        self.active = np.array(active, dtype=bool)
+        
+        # keep the sums about the middle of the data, so they stay small
+        self.origin = np.mean(data, axis=0)
+        self.points = data - self.origin
+        points = self.points[self.active]
+        self.count = points.shape[0]
+        self.total = np.sum(points, axis=0)
+        self.cross = np.dot(points[:,0:2].T, points[:,2:4])
+    
+    
+    def set_active(self, idx, value):
+        """
+        Switch one object on or off, and update the sums to match
+        @param idx:
+            The index of the object
+        @param value:
+            Whether it should be included in the fit
+        @returns:
+            True if that changed anything, or False if it was already so
+        """
+        value = bool(value)
+        if self.active[idx] == value:
+            return False
+        sign = 1 if value else -1
+        point = self.points[idx]
+        self.active[idx] = value
+        self.count += sign
+        self.total += sign*point
+        self.cross += sign*np.outer(point[0:2], point[2:4])
+        return True
+    
+    
+    def solve(self):
+        """
+        Find the rotation and shift that best map the active holes onto their
+        stars, from the sums alone
+        @returns:
+            A tuple of floats: (x_shift, y_shift, rotation in radians), the same
+            as solve_transform, or None if there are no active objects
+        """
+        if self.count == 0:
+            return None
+        
+        mean = self.total/self.count
+        cross = self.cross - self.count*np.outer(mean[0:2], mean[2:4])
+        u, s, v = np.linalg.svd(cross)
+        rot_mat = np.dot(u, v)
+        centroid = mean + self.origin
+        shift = centroid[2:4] - np.dot(centroid[0:2], rot_mat)
+        try:
+            theta = np.mean([math.acos(rot_mat[0,0]), math.asin(rot_mat[1,0])])
+        except ValueError:
+            theta = 0
+        return (shift[0], shift[1], theta)
+
+#END
+